@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# Times PlotSummary's stages against synthetic texts
+# Copyright Martin Paul Eve 2015
+
+"""benchmark: Times PlotSummary's stages against synthetic Zipf-distributed texts
+
+Usage:
+    benchmark.py <output> [options]
+    benchmark.py (-h | --help)
+
+Options:
+    -b, --budget <budget>                           With --startup, exit non-zero if any mode takes longer (seconds)
+    -d, --debug                                     Enable debug output
+    -h --help                                       Show this screen.
+    -r, --repeat <repeat>                           Specify how many times to run each stage (default: 1)
+    -s, --sizes <sizes>                             Specify comma-separated text sizes in tokens (default: 10000,100000,1000000)
+    --seed <seed>                                   Specify the random seed (default: 0)
+    --startup                                       Time the cold start of plotsummary.py in each mode instead
+    --stages <stages>                               Specify comma-separated stages to run (default: all)
+    -v, --vocabulary <vocabulary>                   Specify the number of distinct words (default: 50000)
+    -z, --zipf <zipf>                               Specify the Zipf exponent of word frequencies (default: 1.1)
+"""
+
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from multiprocessing import Pool
+from os.path import join
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+from debug import Debug, Debuggable
+from docopt import docopt
+from stems import porter
+from text import FileChunks, Text
+
+SYLLABLES = ['ba', 'ce', 'di', 'fo', 'gu', 'ha', 'je', 'ki', 'lo', 'mu', 'na', 're', 'si', 'to', 'vu', 'wa',
+             'ka', 'le', 'mi', 'no', 'pu', 'ra', 'se', 'ti', 'zo', 'an', 'el', 'in', 'or', 'ust', 'eng', 'ith']
+
+# The frequency ranks of the words used as query terms.
+TERM_RANKS = [5, 20, 100, 500]
+
+CAPTION = 'Benchmark'
+
+# The bandwidths the kde_sweep stage estimates every term at.
+SWEEP_BANDWIDTHS = [500, 1000, 2000, 4000]
+
+# A query term that is in no synthetic text (no syllable has a q or an x).
+ABSENT_TERM = 'quixotic'
+
+# The plotsummary.py command line of each mode, timed from a cold start.
+STARTUP_MODES = OrderedDict([
+    ('help', ['--help']),
+    ('single', ['single', '{dir}', '{term_file}']),
+    ('hist', ['hist', '{dir}', '{term_file}', '--words', '100']),
+    ('group', ['group', '{dir}', '{term_file}', 'first', '{term_file}', 'second']),
+    ('overlap', ['overlap', '{dir}', '{term}', '{term}']),
+    ('overlap-export', ['overlap', '{dir}', '{term}', '{absent}', '--export', 'csv']),
+    ('rawcount', ['rawcount', '{dir}', '{term_file}', '--words', '100']),
+    ('rawcount-export', ['rawcount', '{dir}', '{term_file}', '--words', '100', '--export', 'csv']),
+    ('search', ['search', '{dir}', '{term}', '5']),
+    ('matrix', ['matrix', '{dir}', '{term_file}']),
+    ('compare', ['compare', '{dir}', '{term_file}']),
+])
+
+# The size of the text used for cold start timings, small enough that the
+# time is dominated by interpreter start up and imports.
+STARTUP_TOKENS = 1000
+
+
+def generate_text(path, tokens, vocabulary=50000, exponent=1.1, seed=0, chunk=100000):
+    """
+    Write a synthetic text whose word frequencies follow a Zipf distribution
+    @param path: the file to write
+    @param tokens: the number of words in the text
+    @param vocabulary: the number of distinct words
+    @param exponent: the Zipf exponent
+    @param seed: the random seed
+    @param chunk: the number of words generated at a time
+    @return: the words, most frequent first
+    """
+    rng = np.random.RandomState(seed)
+
+    words = []
+    seen = set()
+    while len(words) < vocabulary:
+        word = ''.join(rng.choice(SYLLABLES, rng.randint(2, 5)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+
+    weights = 1.0 / np.arange(1, vocabulary + 1) ** exponent
+    weights /= weights.sum()
+
+    with open(path, 'w') as f:
+        for start in range(0, tokens, chunk):
+            ranks = rng.choice(vocabulary, size=min(chunk, tokens - start), p=weights)
+            sentence_ends = rng.random_sample(len(ranks)) < 0.08
+
+            f.write(' '.join(words[r] + '.' if end else words[r] for r, end in zip(ranks, sentence_ends)))
+            f.write('\n')
+
+    return words
+
+
+def peak_rss():
+    """
+    The peak resident set size of this process (kilobytes on Linux, bytes on OS X)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def save(graph, out_dir):
+    graph.savefig(join(out_dir, 'benchmark.png'))
+    graph.close()
+
+
+def bench_tokenize(path, terms, out_dir):
+    start = time.time()
+    Text.from_file(path, Debug())
+    return time.time() - start
+
+
+def bench_tokenize_stream(path, terms, out_dir):
+    start = time.time()
+    Text(FileChunks(path), Debug())
+    return time.time() - start
+
+
+def bench_tokenize_targets(path, terms, out_dir):
+    start = time.time()
+    Text.from_file(path, Debug(), targets=terms)
+    return time.time() - start
+
+
+def bench_kde(path, terms, out_dir):
+    text = Text.from_file(path, Debug(), targets=terms)
+    start = time.time()
+    for term in terms:
+        text.kde(text.stem(term))
+    return time.time() - start
+
+
+def bench_kde_sweep(path, terms, out_dir):
+    text = Text.from_file(path, Debug(), targets=terms)
+    start = time.time()
+    text.density_sweep([text.stem(term) for term in terms], SWEEP_BANDWIDTHS)
+    return time.time() - start
+
+
+def bench_anchored_scores(path, terms, out_dir):
+    text = Text.from_file(path, Debug())
+    start = time.time()
+    text.anchored_scores(text.stem(terms[0]))
+    return time.time() - start
+
+
+def bench_single(path, terms, out_dir):
+    text = Text.from_file(path, Debug(), targets=terms)
+    start = time.time()
+    save(text.plot_terms(terms, CAPTION), out_dir)
+    return time.time() - start
+
+
+def bench_group(path, terms, out_dir):
+    text = Text.from_file(path, Debug(), targets=terms)
+    half = len(terms) // 2
+    start = time.time()
+    save(text.plot_terms_two_groups(terms[:half], 'first', terms[half:], 'second', CAPTION), out_dir)
+    return time.time() - start
+
+
+def bench_hist(path, terms, out_dir):
+    text = Text.from_file(path, Debug(), targets=terms)
+    start = time.time()
+    save(text.plot_terms_histogram(terms, CAPTION, 5000), out_dir)
+    return time.time() - start
+
+
+def bench_rawcount(path, terms, out_dir):
+    text = Text.from_file(path, Debug(), targets=terms)
+    start = time.time()
+    save(text.plot_terms_raw_count(terms, CAPTION, 5000), out_dir)
+    return time.time() - start
+
+
+def bench_overlap(path, terms, out_dir):
+    text = Text.from_file(path, Debug(), targets=terms[:2])
+    start = time.time()
+    save(text.plot_kde_overlap(terms[:2]), out_dir)
+    return time.time() - start
+
+
+def bench_search(path, terms, out_dir):
+    text = Text.from_file(path, Debug())
+    anchor = text.stem(terms[0])
+    start = time.time()
+    text.anchored_scores(anchor, min_occurrences=2, count=20, exclude=[anchor])
+    return time.time() - start
+
+
+STAGES = OrderedDict([
+    ('tokenize', bench_tokenize),
+    ('tokenize_stream', bench_tokenize_stream),
+    ('tokenize_targets', bench_tokenize_targets),
+    ('kde', bench_kde),
+    ('kde_sweep', bench_kde_sweep),
+    ('anchored_scores', bench_anchored_scores),
+    ('single', bench_single),
+    ('group', bench_group),
+    ('hist', bench_hist),
+    ('rawcount', bench_rawcount),
+    ('overlap', bench_overlap),
+    ('search', bench_search),
+])
+
+
+def measure(task):
+    """
+    Run one stage, in a fresh worker process so that its peak memory is its own
+    @param task: a (stage, path, terms, out_dir) tuple
+    @return: the elapsed time, the peak memory and how much the stage raised it
+    """
+    stage, path, terms, out_dir = task
+
+    # Import time is measured by --startup, not here.
+    porter()
+
+    before = peak_rss()
+    seconds = STAGES[stage](path, terms, out_dir)
+    after = peak_rss()
+
+    return seconds, after, after - before
+
+
+class Benchmark (Debuggable):
+    def __init__(self):
+        self.args = docopt(__doc__)
+
+        self.debug = Debug()
+
+        Debuggable.__init__(self, 'benchmark')
+
+        if self.args['--debug']:
+            self.debug.enable_debug()
+
+        self.output = self.args['<output>']
+        self.sizes = [int(size) for size in (self.args['--sizes'] or '10000,100000,1000000').split(',')]
+        self.vocabulary = int(self.args['--vocabulary'] or 50000)
+        self.zipf = float(self.args['--zipf'] or 1.1)
+        self.repeat = int(self.args['--repeat'] or 1)
+        self.seed = int(self.args['--seed'] or 0)
+
+        if self.args['--stages']:
+            self.stages = self.args['--stages'].split(',')
+        else:
+            self.stages = list(STAGES)
+
+        for stage in self.stages:
+            if stage not in STAGES:
+                self.debug.fatal_error(self, u'Unknown stage {0}; choose from {1}'.format(stage, u', '.join(STAGES)))
+
+    def run_startup(self, work_dir):
+        """
+        Time plotsummary.py in each mode, in a fresh interpreter, against a tiny text
+        @param work_dir: a scratch directory
+        @return: the results, and whether every mode was within the budget
+        """
+        text_dir = join(work_dir, 'startup')
+        os.mkdir(text_dir)
+
+        words = generate_text(join(text_dir, 'startup.txt'), STARTUP_TOKENS, 100, self.zipf, self.seed)
+
+        term_file = join(work_dir, 'terms.txt')
+        with open(term_file, 'w') as f:
+            f.write('\n'.join(words[:3]) + '\n')
+
+        script = join(os.path.dirname(os.path.abspath(__file__)), 'plotsummary.py')
+        budget = float(self.args['--budget']) if self.args['--budget'] else None
+        within_budget = True
+        results = []
+
+        env = dict(os.environ, MPLBACKEND='Agg')
+
+        with open(os.devnull, 'w') as devnull:
+            for mode, arguments in STARTUP_MODES.items():
+                command = [sys.executable, script] + [
+                    argument.format(dir=text_dir, term_file=term_file, term=words[0], absent=ABSENT_TERM)
+                    for argument in arguments]
+
+                for run in range(self.repeat):
+                    start = time.time()
+                    status = subprocess.call(command, stdout=devnull, env=env)
+                    seconds = time.time() - start
+
+                    over = budget is not None and seconds > budget
+                    within_budget = within_budget and not over and status == 0
+
+                    self.debug.print_(self, u'startup {0}: {1:.3f}s{2}'.format(
+                        mode, seconds, u' (over budget)' if over else u''))
+
+                    results.append(OrderedDict([
+                        ('stage', 'startup:' + mode),
+                        ('tokens', STARTUP_TOKENS),
+                        ('run', run),
+                        ('seconds', seconds),
+                        ('status', status),
+                        ('budget', budget),
+                    ]))
+
+        return results, within_budget
+
+    @staticmethod
+    def revision():
+        try:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def run_stages(self, work_dir):
+        """
+        Time each stage against a synthetic text of each size
+        @param work_dir: a scratch directory
+        @return: the results
+        """
+        results = []
+
+        for size in self.sizes:
+            path = join(work_dir, '{0}.txt'.format(size))
+
+            self.debug.print_debug(self, u'Generating a {0} token text'.format(size))
+            words = generate_text(path, size, self.vocabulary, self.zipf, self.seed)
+            terms = [words[rank] for rank in TERM_RANKS if rank < len(words)]
+
+            for stage in self.stages:
+                for run in range(self.repeat):
+                    # One task per worker, so no stage inherits another's memory.
+                    pool = Pool(1, maxtasksperchild=1)
+                    try:
+                        seconds, peak, growth = pool.apply(measure, [(stage, path, terms, work_dir)])
+                    finally:
+                        pool.close()
+                        pool.join()
+
+                    self.debug.print_(self, u'{0} tokens, {1}: {2:.3f}s, peak memory {3}'.format(
+                        size, stage, seconds, peak))
+
+                    results.append(OrderedDict([
+                        ('stage', stage),
+                        ('tokens', size),
+                        ('run', run),
+                        ('seconds', seconds),
+                        ('peak_rss', peak),
+                        ('rss_growth', growth),
+                    ]))
+
+        return results
+
+    def run(self):
+        work_dir = tempfile.mkdtemp(prefix='plotsummary-benchmark-')
+        within_budget = True
+
+        try:
+            if self.args['--startup']:
+                results, within_budget = self.run_startup(work_dir)
+            else:
+                results = self.run_stages(work_dir)
+        finally:
+            shutil.rmtree(work_dir)
+
+        report = OrderedDict([
+            ('revision', self.revision()),
+            ('timestamp', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('python', platform.python_version()),
+            ('platform', platform.platform()),
+            ('vocabulary', self.vocabulary),
+            ('zipf', self.zipf),
+            ('seed', self.seed),
+            ('results', results),
+        ])
+
+        with open(self.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        self.debug.print_debug(self, u'Wrote {0}'.format(self.output))
+
+        return 0 if within_budget else 1
+
+
+def main():
+    benchmark_instance = Benchmark()
+    sys.exit(benchmark_instance.run())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+# The default memory cap of the density cache, in bytes.
+DEFAULT_MAX_BYTES = 256 << 20
+
+
+class DensityCache(object):
+
+    """
+    A least-recently-used cache of density arrays, bounded by the bytes they
+    occupy rather than by their number, with an optional directory of .npy
+    files behind it so that densities survive from one run to the next.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, directory=None):
+
+        """
+        Args:
+            max_bytes (int): The most memory the cached arrays may occupy.
+            directory (str): Where to keep densities between runs, if anywhere.
+        """
+
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text_key, term, bandwidth, samples, kernel, engine):
+
+        """
+        The cache key of a density.
+
+        Args:
+            text_key (str): Identifies the tokenized text (see index.index_key).
+            term (str): The stemmed term.
+            bandwidth (int): The kernel bandwidth.
+            samples (int): The number of sample points.
+            kernel (str): The kernel function.
+            engine (str): The density engine.
+        """
+
+        if isinstance(term, unicode):
+            term = term.encode('utf8')
+
+        parts = [text_key, term, repr(bandwidth), repr(samples), kernel, engine or '']
+        return hashlib.sha1(b'\0'.join(parts)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.npy')
+
+    def get(self, key):
+
+        """
+        Look up a density, in memory and then on disk.
+
+        Returns:
+            np.array: The density, or None.
+        """
+
+        if key in self.entries:
+            self.entries[key] = self.entries.pop(key)
+            self.hits += 1
+            return self.entries[key]
+
+        if self.directory:
+            try:
+                density = np.load(self.path(key))
+            except (IOError, ValueError):
+                pass
+            else:
+                self.disk_hits += 1
+                self.remember(key, density)
+                return density
+
+        self.misses += 1
+        return None
+
+    def put(self, key, density):
+
+        """
+        Store a density in memory and, if there is a cache directory, on disk.
+        """
+
+        self.remember(key, density)
+
+        if self.directory:
+            path = self.path(key)
+            temp = path + '.tmp'
+
+            try:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+
+                with open(temp, 'wb') as f:
+                    np.save(f, density)
+                os.rename(temp, path)
+
+            except (IOError, OSError):
+                pass
+
+    def remember(self, key, density):
+
+        """
+        Hold a density in memory, evicting the least recently used ones to
+        stay within max_bytes.
+        """
+
+        density.flags.writeable = False
+
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key).nbytes
+
+        if density.nbytes > self.max_bytes:
+            return
+
+        self.entries[key] = density
+        self.bytes += density.nbytes
+
+        while self.bytes > self.max_bytes:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+
+DENSITY_CACHE = DensityCache()
+
+
+def configure(max_bytes=None, directory=None):
+
+    """
+    Configure the density cache shared by every text in the process.
+
+    Args:
+        max_bytes (int): The memory cap.
+        directory (str): The on-disk tier, or None for memory only.
+    """
+
+    if max_bytes is not None:
+        DENSITY_CACHE.max_bytes = max_bytes
+
+    DENSITY_CACHE.directory = directory
+    DENSITY_CACHE.clear()
@@ -0,0 +1,279 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+# scipy is slow to import, so it is only imported once a matrix is built.
+
+
+class Corpus(object):
+
+    """
+    A document x term count matrix of every text tokenized in a run,
+    together with each document's total token count.
+
+    Each text's term counts are read off its TermIndex as soon as it has been
+    tokenized, so corpus statistics never need a text to be read again. Terms
+    are given corpus-wide column IDs in order of first appearance, and the
+    counts of each document are kept as a (columns, counts) pair of arrays
+    until a scipy.sparse matrix is asked for.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.ids = {}
+        self.vocabulary = []
+        self.documents = []
+        self.tokens = []
+        self.rows = []
+        self.cached = None
+
+    def intern(self, term):
+        column = self.ids.get(term)
+        if column is None:
+            column = self.ids[term] = len(self.vocabulary)
+            self.vocabulary.append(term)
+        return column
+
+    def add(self, name, vocabulary, counts, tokens):
+
+        """
+        Add a document, replacing any earlier one of the same name.
+
+        Args:
+            name (str): The document name.
+            vocabulary (list): The terms it contains.
+            counts (np.array): The number of occurrences of each term.
+            tokens (int): The total number of tokens, stopwords included.
+        """
+
+        counts = np.asarray(counts, dtype=np.int64)
+        columns = np.array([self.intern(term) for term in vocabulary], dtype=np.int64)
+        present = counts > 0
+
+        if name in self.documents:
+            row = self.documents.index(name)
+            self.tokens[row] = tokens
+            self.rows[row] = (columns[present], counts[present])
+        else:
+            self.documents.append(name)
+            self.tokens.append(tokens)
+            self.rows.append((columns[present], counts[present]))
+
+        self.cached = None
+
+    def prune(self, names):
+
+        """
+        Drop the documents that are not in a list. Their terms keep their
+        columns, with no counts.
+
+        Args:
+            names (list): The documents to keep.
+        """
+
+        names = set(names)
+        keep = [row for row, name in enumerate(self.documents) if name in names]
+
+        if len(keep) == len(self.documents):
+            return
+
+        self.documents = [self.documents[row] for row in keep]
+        self.tokens = [self.tokens[row] for row in keep]
+        self.rows = [self.rows[row] for row in keep]
+        self.cached = None
+
+    def add_text(self, name, text):
+
+        """
+        Add a tokenized Text, from its term index.
+
+        Args:
+            name (str): The document name.
+            text (Text): The text.
+        """
+
+        self.add(name, text.terms.vocabulary, text.terms.counts(), len(text.tokens))
+
+    def take_documents(self):
+
+        """
+        Remove and return every document added so far, for a worker process
+        to hand back to its parent (see merge).
+
+        Returns:
+            list: (name, vocabulary, counts, tokens) tuples.
+        """
+
+        documents = [(name, [self.vocabulary[column] for column in columns], counts, tokens)
+                     for name, tokens, (columns, counts) in zip(self.documents, self.tokens, self.rows)]
+
+        self.clear()
+        return documents
+
+    def merge(self, documents):
+
+        """
+        Add documents returned by take_documents.
+        """
+
+        for name, vocabulary, counts, tokens in documents:
+            self.add(name, vocabulary, counts, tokens)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def matrix(self):
+
+        """
+        The document x term count matrix, built once per change.
+
+        Returns:
+            scipy.sparse.csr_matrix: One row per document, one column per term.
+        """
+
+        if self.cached is None:
+            from scipy import sparse
+
+            sizes = [len(columns) for columns, counts in self.rows]
+
+            indptr = np.zeros(len(self.rows) + 1, dtype=np.int64)
+            np.cumsum(sizes, out=indptr[1:])
+
+            indices = np.concatenate([columns for columns, counts in self.rows]) if self.rows else np.zeros(0, np.int64)
+            data = np.concatenate([counts for columns, counts in self.rows]) if self.rows else np.zeros(0, np.int64)
+
+            self.cached = sparse.csr_matrix((data, indices, indptr), shape=(len(self.rows), len(self.vocabulary)))
+            self.cached.sort_indices()
+
+        return self.cached
+
+    def token_totals(self):
+
+        """
+        The number of tokens in each document.
+        """
+
+        return np.array(self.tokens, dtype=np.int64)
+
+    def term_totals(self):
+
+        """
+        The number of occurrences of each term across every document.
+        """
+
+        return np.asarray(self.matrix().sum(axis=0)).ravel()
+
+    def document_frequency(self):
+
+        """
+        The number of documents each term occurs in.
+        """
+
+        return np.bincount(self.matrix().indices, minlength=len(self.vocabulary))
+
+    def idf(self):
+
+        """
+        The smoothed inverse document frequency of each term:
+        log((1 + documents) / (1 + document frequency)) + 1.
+        """
+
+        return np.log((1.0 + len(self.documents)) / (1.0 + self.document_frequency())) + 1
+
+    def tfidf(self):
+
+        """
+        Term frequency (occurrences per token of the document) times inverse
+        document frequency.
+
+        Returns:
+            scipy.sparse.csr_matrix: One row per document, one column per term.
+        """
+
+        from scipy import sparse
+
+        tokens = self.token_totals().astype(float)
+        scale = sparse.diags(1 / np.where(tokens > 0, tokens, 1))
+
+        return (scale * self.matrix()).multiply(self.idf()).tocsr()
+
+    def statistics(self):
+
+        """
+        The corpus statistics of every term.
+
+        Returns:
+            OrderedDict: Equal-length columns, one row per term.
+        """
+
+        columns = OrderedDict()
+        columns['term'] = self.vocabulary
+        columns['total'] = self.term_totals()
+        columns['documents'] = self.document_frequency()
+        columns['idf'] = self.idf()
+
+        return columns
+
+    def save(self, path):
+
+        """
+        Write the matrix, the vocabulary, the document names and token totals
+        to a .npz archive.
+        """
+
+        matrix = self.matrix()
+        temp = path + '.tmp'
+
+        with open(temp, 'wb') as f:
+            np.savez(f, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                     shape=np.array(matrix.shape), vocabulary=np.array(self.vocabulary),
+                     documents=np.array(self.documents), tokens=self.token_totals())
+
+        os.rename(temp, path)
+
+    @classmethod
+    def load(cls, path):
+
+        """
+        Read a corpus written by save.
+        """
+
+        corpus = cls()
+
+        with np.load(path) as archive:
+            indptr = archive['indptr']
+            indices = archive['indices']
+            data = archive['data']
+            vocabulary = archive['vocabulary'].tolist()
+
+            for row, (name, tokens) in enumerate(zip(archive['documents'].tolist(), archive['tokens'].tolist())):
+                columns = indices[indptr[row]:indptr[row + 1]]
+                corpus.add(name, [vocabulary[column] for column in columns], data[indptr[row]:indptr[row + 1]], tokens)
+
+        return corpus
+
+
+CORPUS = Corpus()
+
+
+def configure(path=None):
+
+    """
+    Start the corpus shared by every text in the process from a file written
+    by Corpus.save, if there is one, so that the documents of texts that are
+    not processed again (e.g. with --incremental) are kept.
+
+    Args:
+        path (str): The corpus file.
+    """
+
+    CORPUS.clear()
+
+    if path and os.path.exists(path):
+        try:
+            CORPUS.merge(Corpus.load(path).take_documents())
+        except (IOError, ValueError, KeyError):
+            pass
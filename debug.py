@@ -5,6 +5,41 @@ __email__ = "martin@martineve.com"
 
 import sys
 import os
+import json
+import time
+from collections import OrderedDict
+
+
+class Span(object):
+    """
+    Times a block of code, adding the elapsed seconds to a named total
+    """
+    def __init__(self, totals, name):
+        self.totals = totals
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.totals[self.name] = self.totals.get(self.name, 0.0) + time.time() - self.start
+        return False
+
+
+class NullSpan(object):
+    """
+    Stands in for a Span when metrics are off, so that timing costs nothing
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
 
 class Debug(object):
     def __init__(self):
@@ -15,6 +50,10 @@ class Debug(object):
         self.debug = False
         self.has_run = False
         self.prompt = None
+        self.buffer = None
+        self.metrics = None
+        self.record = None
+        self.metrics_buffer = None
 
     def enable_debug(self):
         self.debug = True
@@ -22,12 +61,120 @@ class Debug(object):
     def enable_prompt(self, prompt):
         self.prompt = prompt
 
+    def enable_metrics(self, path):
+        """
+        Append a JSON line of stage timings and counters to a file for every record
+        @param path: the metrics file
+        """
+        self.metrics = path
+
+    def begin_record(self, **fields):
+        """
+        Start collecting spans and counters for one unit of work (e.g. a file)
+        @param fields: identifying fields to include in the record
+        """
+        if self.metrics is None:
+            return
+
+        self.record = OrderedDict(sorted(fields.items()))
+        self.record['spans'] = {}
+        self.record['counters'] = {}
+
+    def span(self, name):
+        """
+        Time a block of code: with debug.span('kde'): ...
+        @param name: the name to accumulate the elapsed time under
+        """
+        if self.record is None:
+            return NULL_SPAN
+
+        return Span(self.record['spans'], name)
+
+    def count(self, name, value=1):
+        """
+        Add to a named counter in the current record
+        @param name: the counter name
+        @param value: the amount to add
+        """
+        if self.record is None:
+            return
+
+        counters = self.record['counters']
+        counters[name] = counters.get(name, 0) + value
+
+    def end_record(self):
+        """
+        Finish the current record and write it out (or hold it back while capturing)
+        """
+        record, self.record = self.record, None
+
+        if record is None:
+            return
+
+        spans, counters = record['spans'], record['counters']
+        if counters.get('tokens') and spans.get('tokenize'):
+            record['tokens_per_second'] = counters['tokens'] / spans['tokenize']
+
+        if self.metrics_buffer is not None:
+            self.metrics_buffer.append(record)
+        else:
+            self.write_metrics([record])
+
+    def write_metrics(self, records):
+        """
+        Append records to the metrics file as JSON lines
+        @param records: the records, possibly captured in another process
+        """
+        if self.metrics is None or not records:
+            return
+
+        with open(self.metrics, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
     def print_(self, module, message):
         if self.prompt is None:
-            print(u'[{0}] {1}'.format(module.get_module_name(), unicode(message)))
+            line = u'[{0}] {1}'.format(module.get_module_name(), unicode(message))
+        else:
+            line = u'[{0}] {1}'.format(self.prompt.colorize('red', module.get_module_name()), unicode(message))
+
+        if self.buffer is not None:
+            self.buffer.append(line)
+        else:
+            self.print_line(line)
+
+    def print_line(self, line):
+        if self.prompt is None:
+            print(line)
         else:
-            self.prompt.print_(u'[{0}] {1}'.format(self.prompt.colorize('red', module.get_module_name()),
-                                                   unicode(message)))
+            self.prompt.print_(line)
+
+    def capture(self):
+        """
+        Hold back all further output until release() is called, so that a worker process can hand its output
+        to the parent to be printed in order
+        """
+        self.buffer = []
+        self.metrics_buffer = []
+
+    def release(self):
+        """
+        Stop capturing output
+        @return: the lines and metrics records captured since capture() was called
+        """
+        lines = self.buffer or []
+        records = self.metrics_buffer or []
+        self.buffer = None
+        self.metrics_buffer = None
+        return lines, records
+
+    def replay(self, lines):
+        """
+        Print lines captured (possibly in another process) by release()
+        @param lines: the captured lines
+        """
+        for line in lines:
+            self.print_line(line)
 
     def get_module_name(self):
         return 'Debugger'
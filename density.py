@@ -0,0 +1,422 @@
+"""
+Kernel density engines for term offsets.
+
+Every engine takes the offsets of a term, the length of the text in tokens,
+the kernel bandwidth, the number of evenly-spaced sample points and the kernel
+name, and returns the density (integrating to 1 over the text) at
+np.linspace(0, length, samples). Text.kde applies the plotting scale on top.
+
+Engines:
+    sklearn: Fits sklearn.neighbors.KernelDensity and scores every sample
+        point against every occurrence. Exact, but O(occurrences x samples).
+    truncated: Evaluates the kernel directly, but only against occurrences
+        within the kernel's support (or TRUNCATE bandwidths for the unbounded
+        kernels). Agrees with sklearn to within floating point error.
+    fft: Linearly bins the offsets onto the sample grid and convolves the bins
+        with the sampled kernel via FFT. O(occurrences + samples log samples).
+
+The fft engine is the default for the gaussian kernel: it benchmarks fastest
+by a wide margin. Its error comes from binning, and is worst for terms that
+occur only once. Measured against an exact gaussian estimate, as the largest
+absolute difference relative to the exact peak, it is 2.9% at a bandwidth of
+2 bins, 1.9% at 2.5 and 1.3% at 3. So whenever the bandwidth is under
+MIN_FFT_STEPS (3) sample grid steps, the offsets are binned on a grid that
+many times finer (see oversampling), which keeps the error under 1.5%. With
+the default bandwidth of 2000 and 1000 samples, the grid step is
+length / 999, so texts of up to 666,000 tokens are binned on the sample grid
+itself. Compact kernels (tophat etc.) are less forgiving of binning, so they
+use truncated when no engine is requested.
+"""
+
+import numpy as np
+from collections import OrderedDict
+
+DEFAULT_ENGINE = 'fft'
+
+# The narrowest bandwidth, in bins, the fft engine convolves with.
+MIN_FFT_STEPS = 3
+
+# The most grid points the fft engine transforms at once, across all rows.
+FFT_BLOCK = 1 << 22
+
+# Unbounded kernels are cut off this many bandwidths from each occurrence.
+TRUNCATE = 8
+
+# Kernel profiles in units of the bandwidth, matching the normalization used
+# by sklearn.neighbors.KernelDensity: (profile, normalization, support).
+KERNELS = {
+    'gaussian': (lambda u: np.exp(-0.5 * u * u), 1 / np.sqrt(2 * np.pi), TRUNCATE),
+    'tophat': (lambda u: (u < 1).astype(float), 0.5, 1),
+    'epanechnikov': (lambda u: np.where(u < 1, 1 - u * u, 0.0), 0.75, 1),
+    'exponential': (lambda u: np.exp(-u), 0.5, 3 * TRUNCATE),
+    'linear': (lambda u: np.where(u < 1, 1 - u, 0.0), 1.0, 1),
+    'cosine': (lambda u: np.where(u < 1, np.cos(0.5 * np.pi * u), 0.0), 0.25 * np.pi, 1),
+}
+
+
+def kernel_weights(kernel, distance, bandwidth):
+
+    """
+    Evaluate a normalized kernel at a set of distances.
+
+    Args:
+        kernel (str): The kernel function.
+        distance (np.array): Distances from the kernel centre, in tokens.
+        bandwidth (float): The kernel bandwidth.
+
+    Returns:
+        np.array: The kernel weights.
+    """
+
+    profile, norm, support = KERNELS[kernel]
+    return profile(np.abs(distance) / float(bandwidth)) * (norm / float(bandwidth))
+
+
+def kernel_support(kernel, bandwidth):
+
+    """
+    The distance beyond which a kernel is treated as zero.
+
+    Args:
+        kernel (str): The kernel function.
+        bandwidth (float): The kernel bandwidth.
+    """
+
+    return KERNELS[kernel][2] * float(bandwidth)
+
+
+def sample_grid(length, samples):
+
+    """
+    The evenly-spaced sample points and the step between them.
+
+    Args:
+        length (int): The number of tokens in the text.
+        samples (int): The number of sample points.
+    """
+
+    grid = np.linspace(0, length, samples)
+    step = grid[1] - grid[0] if samples > 1 else float(length or 1)
+    return grid, step
+
+
+def bin_offsets(offsets, step, samples, rows=None, height=1):
+
+    """
+    Linearly bin offsets onto the sample grid, splitting each occurrence
+    between its two neighbouring grid points.
+
+    Args:
+        offsets (np.array): The term offsets.
+        step (float): The distance between grid points.
+        samples (int): The number of grid points.
+        rows (np.array): The output row of each offset, if binning many terms.
+        height (int): The number of output rows.
+
+    Returns:
+        np.array: The (fractional) count at each grid point, one row per term.
+    """
+
+    position = np.asarray(offsets, dtype=float) / step
+    left = np.clip(np.floor(position).astype(int), 0, samples - 1)
+    right = np.minimum(left + 1, samples - 1)
+    fraction = np.clip(position - left, 0, 1)
+
+    if rows is not None:
+        left = left + rows * samples
+        right = right + rows * samples
+
+    size = height * samples
+    counts = (np.bincount(left, 1 - fraction, size) +
+              np.bincount(right, fraction, size))
+
+    return counts.reshape(height, samples)
+
+
+def sklearn_density(offsets, length, bandwidth, samples, kernel):
+
+    """
+    Fit sklearn's KernelDensity and score the sample grid.
+    """
+
+    from sklearn.neighbors import KernelDensity
+
+    points = np.asarray(offsets, dtype=float)[:, np.newaxis]
+    kde = KernelDensity(kernel=kernel, bandwidth=bandwidth).fit(points)
+
+    grid, step = sample_grid(length, samples)
+    return np.exp(kde.score_samples(grid[:, np.newaxis]))
+
+
+def truncated_density(offsets, length, bandwidth, samples, kernel):
+
+    """
+    Evaluate the kernel at each sample point against nearby occurrences only.
+    """
+
+    offsets = np.sort(np.asarray(offsets, dtype=float))
+    grid, step = sample_grid(length, samples)
+    radius = kernel_support(kernel, bandwidth)
+
+    lo = np.searchsorted(offsets, grid - radius, 'left')
+    hi = np.searchsorted(offsets, grid + radius, 'right')
+
+    density = np.zeros(samples)
+    for i in np.flatnonzero(hi > lo):
+        near = offsets[lo[i]:hi[i]]
+        density[i] = kernel_weights(kernel, grid[i] - near, bandwidth).sum()
+
+    return density / len(offsets)
+
+
+def fft_density(offsets, length, bandwidth, samples, kernel):
+
+    """
+    Bin the occurrences onto the sample grid and convolve with the kernel.
+    """
+
+    return fft_density_matrix([offsets], length, bandwidth, samples, kernel)[0]
+
+
+def fft_density_matrix(postings, length, bandwidth, samples, kernel):
+
+    """
+    The fft engine for many terms at once: every term is binned in a single
+    pass and all rows are convolved with one batched FFT.
+    """
+
+    return fft_density_sweep(postings, length, [bandwidth], samples, kernel)[0]
+
+
+def oversampling(length, bandwidth, samples):
+
+    """
+    How many times finer than the sample grid the fft engine bins offsets, so
+    that the bandwidth spans at least MIN_FFT_STEPS bins. The bins are never
+    made narrower than a token.
+
+    Args:
+        length (int): The number of tokens in the text.
+        bandwidth (float): The kernel bandwidth.
+        samples (int): The number of evenly-spaced sample points.
+    """
+
+    grid, step = sample_grid(length, samples)
+
+    if bandwidth >= MIN_FFT_STEPS * step:
+        return 1
+
+    return int(max(1, min(np.ceil(MIN_FFT_STEPS * step / float(bandwidth)), np.ceil(step))))
+
+
+def fft_density_sweep(postings, length, bandwidths, samples, kernel):
+
+    """
+    The fft engine for many terms at many bandwidths: the terms are binned
+    and transformed once, padded for the widest kernel, and each bandwidth
+    then costs one kernel transform, one product and one inverse FFT.
+
+    Narrow bandwidths are binned onto a grid oversampling() times finer than
+    the sample grid. Over that grid the kernel spans only a few dozen bins,
+    and only every oversampling()th point is needed, so those points are
+    summed directly rather than through an FFT of the whole fine grid. The
+    terms are binned FFT_BLOCK grid points' worth of rows at a time, so a
+    fine grid does not multiply the memory used.
+    """
+
+    grid, step = sample_grid(length, samples)
+
+    factor = max(oversampling(length, bandwidth, samples) for bandwidth in bandwidths)
+    fine_samples = (samples - 1) * factor + 1
+    fine_step = step / factor
+
+    # Sample each kernel at whole fine grid steps, out to its support.
+    radii = [int(min(np.ceil(kernel_support(kernel, bandwidth) / fine_step), fine_samples - 1))
+             for bandwidth in bandwidths]
+    kernels = [kernel_weights(kernel, np.arange(-radius, radius + 1) * fine_step, bandwidth)
+               for bandwidth, radius in zip(bandwidths, radii)]
+
+    size = 1 << int(np.ceil(np.log2(fine_samples + 2 * max(radii))))
+    if factor == 1:
+        transforms = [np.fft.rfft(weights, size) for weights in kernels]
+
+    densities = [np.zeros((len(postings), samples)) for bandwidth in bandwidths]
+    block = max(1, FFT_BLOCK // size)
+
+    for start in range(0, len(postings), block):
+        chunk = postings[start:start + block]
+
+        sizes = np.array([len(offsets) for offsets in chunk])
+        rows = np.repeat(np.arange(len(chunk)), sizes)
+        offsets = np.concatenate(chunk) if len(chunk) else np.zeros(0)
+        counts = bin_offsets(offsets, fine_step, fine_samples, rows, len(chunk))
+
+        if factor == 1:
+            spectrum = np.fft.rfft(counts, size, axis=1)
+        else:
+            padded = np.pad(counts, ((0, 0), (max(radii), max(radii))), 'constant')
+
+        for i, (weights, radius) in enumerate(zip(kernels, radii)):
+            if factor == 1:
+                full = np.fft.irfft(spectrum * transforms[i], size, axis=1)
+                convolved = full[:, radius:radius + samples]
+            else:
+                # The kernel is symmetric, so convolving is correlating.
+                convolved = np.zeros((len(chunk), samples))
+                for shift, weight in enumerate(weights, max(radii) - radius):
+                    convolved += weight * padded[:, shift:shift + fine_samples:factor]
+
+            # FFT round-off can leave tiny negative values where the density is ~0.
+            densities[i][start:start + len(chunk)] = np.maximum(convolved, 0) / np.maximum(sizes, 1)[:, np.newaxis]
+
+    return densities
+
+
+ENGINES = {
+    'sklearn': sklearn_density,
+    'truncated': truncated_density,
+    'fft': fft_density,
+}
+
+
+def default_engine(length, bandwidth, samples, kernel):
+
+    """
+    Pick DEFAULT_ENGINE for the gaussian kernel, and truncated for the rest.
+
+    Args:
+        length (int): The number of tokens in the text.
+        bandwidth (int): The kernel bandwidth.
+        samples (int): The number of evenly-spaced sample points.
+        kernel (str): The kernel function.
+    """
+
+    if kernel == 'gaussian':
+        return DEFAULT_ENGINE
+
+    return 'truncated'
+
+
+def estimate(offsets, length, bandwidth=2000, samples=1000, kernel='gaussian', engine=None):
+
+    """
+    Estimate the kernel density of a set of offsets with the chosen engine.
+
+    Args:
+        offsets (list): The term offsets.
+        length (int): The number of tokens in the text.
+        bandwidth (int): The kernel bandwidth.
+        samples (int): The number of evenly-spaced sample points.
+        kernel (str): The kernel function.
+        engine (str): One of ENGINES; defaults to default_engine().
+
+    Returns:
+        np.array: The density at each sample point.
+    """
+
+    engine = engine or default_engine(length, bandwidth, samples, kernel)
+
+    if engine not in ENGINES:
+        raise ValueError(u'Unknown KDE engine: {0}'.format(engine))
+
+    if kernel not in KERNELS:
+        raise ValueError(u'Unknown kernel: {0}'.format(kernel))
+
+    # An absent term has no density anywhere.
+    if not len(offsets):
+        return np.zeros(samples)
+
+    return ENGINES[engine](offsets, length, bandwidth, samples, kernel)
+
+
+def estimate_matrix(postings, length, bandwidth=2000, samples=1000, kernel='gaussian', engine=None):
+
+    """
+    Estimate the kernel densities of many terms in one batched pass.
+
+    Args:
+        postings (list): The offsets of each term.
+        length (int): The number of tokens in the text.
+        bandwidth (int): The kernel bandwidth.
+        samples (int): The number of evenly-spaced sample points.
+        kernel (str): The kernel function.
+        engine (str): One of ENGINES; defaults to default_engine().
+
+    Returns:
+        np.array: A (terms x samples) matrix of densities.
+    """
+
+    engine = engine or default_engine(length, bandwidth, samples, kernel)
+
+    if engine == 'fft' and kernel in KERNELS:
+        return fft_density_matrix(postings, length, bandwidth, samples, kernel)
+
+    # The other engines have no batched form; stack them row by row.
+    matrix = np.zeros((len(postings), samples))
+    for row, offsets in enumerate(postings):
+        matrix[row] = estimate(offsets, length, bandwidth, samples, kernel, engine)
+
+    return matrix
+
+
+def estimate_sweep(postings, length, bandwidths, samples=1000, kernel='gaussian'):
+
+    """
+    Estimate the kernel densities of many terms at many bandwidths. The
+    bandwidths that default_engine() gives to the fft engine are binned
+    once per oversampling() factor, and only those with a factor of 1 share
+    a transform; the oversampled ones are summed directly, one bandwidth at
+    a time. A wide sweep over a long text (500 to 4000 words over a
+    million tokens) has a different factor for every bandwidth, so it
+    costs about as much as estimating each bandwidth on its own. The
+    bandwidths default_engine() gives to other engines are estimated one
+    at a time too.
+
+    Args:
+        postings (list): The offsets of each term.
+        length (int): The number of tokens in the text.
+        bandwidths (list): The kernel bandwidths.
+        samples (int): The number of evenly-spaced sample points.
+        kernel (str): The kernel function.
+
+    Returns:
+        list: A (terms x samples) matrix of densities for each bandwidth.
+    """
+
+    engines = [default_engine(length, bandwidth, samples, kernel) for bandwidth in bandwidths]
+
+    # Bandwidths binned at the same resolution share a binning, so that each
+    # gets exactly what estimate_matrix would give it.
+    groups = OrderedDict()
+    for bandwidth, engine in zip(bandwidths, engines):
+        if engine == 'fft':
+            groups.setdefault(oversampling(length, bandwidth, samples), []).append(bandwidth)
+
+    swept = {}
+    for group in groups.values():
+        swept.update(zip(group, fft_density_sweep(postings, length, group, samples, kernel)))
+
+    return [swept[bandwidth] if engine == 'fft' else
+            estimate_matrix(postings, length, bandwidth, samples, kernel, engine)
+            for bandwidth, engine in zip(bandwidths, engines)]
+
+
+def engine_key(engine, length, bandwidth, samples):
+
+    """
+    Identifies the engine an estimate was made with in cache keys, including
+    the resolution the fft engine binned at.
+
+    Args:
+        engine (str): The engine.
+        length (int): The number of tokens in the text.
+        bandwidth (int): The kernel bandwidth.
+        samples (int): The number of evenly-spaced sample points.
+    """
+
+    if engine == 'fft':
+        factor = oversampling(length, bandwidth, samples)
+        if factor > 1:
+            return 'fft/{0}'.format(factor)
+
+    return engine
@@ -0,0 +1,91 @@
+import csv
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+FORMATS = ('csv', 'json', 'npz')
+
+
+def cell(value):
+
+    """
+    Format a value for CSV without losing float precision.
+    """
+
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return value
+
+
+def write_csv(path, columns, meta):
+
+    """
+    Write the columns as a CSV table, preceded by "# key: value" lines for
+    each meta entry.
+    """
+
+    with open(path, 'wb') as f:
+        for key, value in meta.items():
+            f.write('# {0}: {1}\n'.format(key, cell(value)))
+
+        writer = csv.writer(f)
+        writer.writerow([cell(name) for name in columns])
+
+        for row in zip(*columns.values()):
+            writer.writerow([cell(value) for value in row])
+
+
+def write_json(path, columns, meta):
+
+    """
+    Write the columns and meta entries as a JSON object.
+    """
+
+    with open(path, 'w') as f:
+        json.dump(OrderedDict([
+            ('meta', meta),
+            ('columns', OrderedDict((name, values.tolist()) for name, values in columns.items())),
+        ]), f)
+
+
+def write_npz(path, columns, meta):
+
+    """
+    Write each column and meta entry as a named array in a .npz archive.
+    """
+
+    arrays = OrderedDict(columns)
+    for key, value in meta.items():
+        arrays['meta:' + key] = np.array(value)
+
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+WRITERS = {
+    'csv': write_csv,
+    'json': write_json,
+    'npz': write_npz,
+}
+
+
+def write(path, format, columns, meta=None):
+
+    """
+    Write the data behind a plot.
+
+    Args:
+        path (str): The output file path.
+        format (str): One of FORMATS.
+        columns (OrderedDict): Equal-length arrays, keyed by column name.
+        meta (OrderedDict): Scalar values that describe the data.
+    """
+
+    if format not in WRITERS:
+        raise ValueError(u'Unknown export format: {0}'.format(format))
+
+    columns = OrderedDict((name, np.asarray(values)) for name, values in columns.items())
+    WRITERS[format](path, columns, meta or OrderedDict())
@@ -0,0 +1,285 @@
+import collections
+import hashlib
+import json
+import os
+import struct
+import numpy as np
+
+MAGIC = b'PLOTSUMMARY-INDEX-1\n'
+
+# Arrays are laid out on this boundary so they can be memory-mapped in place.
+ALIGN = 8
+
+
+class TermIndex(collections.Mapping):
+
+    """
+    A compact, read-only mapping of term -> offsets.
+
+    Terms are interned in order of first appearance, and the offsets of every
+    term are held in one contiguous int32 array, sliced by a pointer array, so
+    the whole index costs a few bytes per token rather than a Python list per
+    term.
+    """
+
+    def __init__(self, vocabulary, offsets, pointers):
+
+        """
+        Args:
+            vocabulary (list): The terms, indexed by term ID.
+            offsets (np.array): The offsets of every term, grouped by term ID.
+            pointers (np.array): Where each term's offsets start and end.
+        """
+
+        self.vocabulary = vocabulary
+        self.ids = dict((term, i) for i, term in enumerate(vocabulary))
+        self.offsets = offsets
+        self.pointers = pointers
+
+    @classmethod
+    def from_token_ids(cls, vocabulary, token_ids):
+
+        """
+        Build the postings from a stream of term IDs.
+
+        Args:
+            vocabulary (list): The terms, indexed by term ID.
+            token_ids (np.array): The term ID at each offset, -1 for stopwords.
+        """
+
+        token_ids = np.asarray(token_ids)
+
+        positions = np.flatnonzero(token_ids >= 0)
+        ids = token_ids[positions]
+
+        # A stable sort keeps each term's offsets in ascending order.
+        order = np.argsort(ids, kind='mergesort')
+        offsets = positions[order].astype(np.int32)
+
+        pointers = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(ids, minlength=len(vocabulary)), out=pointers[1:])
+
+        return cls(vocabulary, offsets, pointers)
+
+    @classmethod
+    def from_postings(cls, postings):
+
+        """
+        Build the index from per-term offset lists.
+
+        Args:
+            postings (OrderedDict): The ascending offsets of each term.
+        """
+
+        vocabulary = list(postings)
+
+        offsets = np.zeros(sum(len(o) for o in postings.values()), dtype=np.int32)
+        pointers = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+
+        for i, term in enumerate(vocabulary):
+            pointers[i + 1] = pointers[i] + len(postings[term])
+            offsets[pointers[i]:pointers[i + 1]] = postings[term]
+
+        return cls(vocabulary, offsets, pointers)
+
+    def __getitem__(self, term):
+        i = self.ids[term]
+        return self.offsets[self.pointers[i]:self.pointers[i + 1]]
+
+    def __contains__(self, term):
+        return term in self.ids
+
+    def __iter__(self):
+        return iter(self.vocabulary)
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def counts(self):
+
+        """
+        The number of occurrences of each term, indexed by term ID.
+        """
+
+        return np.diff(self.pointers)
+
+    def cumulative_counts(self, term, positions):
+
+        """
+        The number of occurrences of a term before each token position.
+
+        A term's offsets are stored in ascending order, so they already form
+        its cumulative count over the text: the count before a position is
+        where that position would be inserted among them.
+
+        Args:
+            term (str): The term.
+            positions (np.array): Token positions, which need not be integers.
+
+        Returns:
+            np.array: The count before each position.
+        """
+
+        return np.searchsorted(self[term], positions, 'left')
+
+    def window_counts(self, term, edges):
+
+        """
+        The number of occurrences of a term in each window [edges[i],
+        edges[i + 1]), for any ascending edges, read off by differencing
+        cumulative_counts.
+
+        Args:
+            term (str): The term.
+            edges (np.array): The window edges.
+
+        Returns:
+            np.array: One count per window.
+        """
+
+        return np.diff(self.cumulative_counts(term, edges))
+
+
+class TokenCount(object):
+
+    """
+    Stands in for the token array of a text whose terms were only partly
+    indexed: it knows how many tokens there are, and nothing else.
+    """
+
+    def __init__(self, count):
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+
+def index_key(chunks, stemmer, stopwords, nostem):
+
+    """
+    Hash everything that determines the tokenized form of a text.
+
+    Args:
+        chunks (iterable): The raw text, in chunks.
+        stemmer (str): An identifier for the stemmer in use.
+        stopwords (set): The stopwords.
+        nostem (set): The words that are not stemmed.
+
+    Returns:
+        str: A hex digest.
+    """
+
+    digest = hashlib.sha1()
+    for chunk in chunks:
+        digest.update(chunk)
+
+    for part in [stemmer] + sorted(stopwords) + [u''] + sorted(nostem):
+        if isinstance(part, unicode):
+            part = part.encode('utf8')
+        digest.update(b'\0' + part)
+
+    return digest.hexdigest()
+
+
+def index_path(path):
+
+    """
+    The index file that sits next to a text.
+
+    Args:
+        path (str): The text file path.
+    """
+
+    return path + '.idx'
+
+
+def padding(position):
+    return -position % ALIGN
+
+
+def write_index(path, key, tokens, terms):
+
+    """
+    Write a tokenized text to disk.
+
+    The file is MAGIC, then an 8-byte header length and a JSON header, then
+    the token IDs, the term offsets and the term pointers, each aligned to
+    ALIGN bytes, then the newline-separated vocabulary.
+
+    Args:
+        path (str): The index file path.
+        key (str): The index_key of the text.
+        tokens (np.array): The term ID at each offset.
+        terms (TermIndex): The term postings.
+    """
+
+    vocabulary = b'\n'.join(terms.vocabulary)
+    header = json.dumps({
+        'key': key,
+        'tokens': len(tokens),
+        'offsets': len(terms.offsets),
+        'terms': len(terms.vocabulary),
+    }).encode('utf8')
+
+    temp = path + '.tmp'
+
+    with open(temp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+
+        for data in [np.asarray(tokens, dtype='<i4'),
+                     np.asarray(terms.offsets, dtype='<i4'),
+                     np.asarray(terms.pointers, dtype='<i8')]:
+            f.write(b'\0' * padding(f.tell()))
+            f.write(data.tobytes())
+
+        f.write(vocabulary)
+
+    os.rename(temp, path)
+
+
+def read_index(path, key):
+
+    """
+    Memory-map a tokenized text from disk.
+
+    Args:
+        path (str): The index file path.
+        key (str): The index_key the text must have been written with.
+
+    Returns:
+        tuple: (tokens, TermIndex), or None if the index is missing or stale.
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+
+            size, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(size).decode('utf8'))
+            position = f.tell()
+
+            if header['key'] != key:
+                return None
+
+            arrays = []
+            for dtype, count in [('<i4', header['tokens']),
+                                 ('<i4', header['offsets']),
+                                 ('<i8', header['terms'] + 1)]:
+                position += padding(position)
+                if count:
+                    arrays.append(np.memmap(path, dtype=dtype, mode='r', offset=position, shape=(count,)))
+                else:
+                    arrays.append(np.zeros(0, dtype=dtype))
+                position += count * np.dtype(dtype).itemsize
+
+            f.seek(position)
+            vocabulary = f.read().split(b'\n') if header['terms'] else []
+
+    except (IOError, ValueError, KeyError, struct.error):
+        return None
+
+    tokens, offsets, pointers = arrays
+    return tokens, TermIndex(vocabulary, offsets, pointers)
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+# The manifest is kept in the text directory under this name.
+MANIFEST_NAME = '.plotsummary-manifest.json'
+
+# The number of bytes read from a file at a time while hashing it.
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_hash(path):
+
+    """
+    Hash the content of a file, a chunk at a time.
+
+    Args:
+        path (str): The file path.
+
+    Returns:
+        str: A hex digest.
+    """
+
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def parameters_key(parameters):
+
+    """
+    Hash the run parameters that determine a text's outputs.
+
+    Args:
+        parameters (OrderedDict): JSON-serializable parameter values.
+
+    Returns:
+        str: A hex digest.
+    """
+
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode('utf8')).hexdigest()
+
+
+class Manifest(object):
+
+    """
+    Records, for every text in a directory, the modification time, size and
+    content hash it had and the parameters it was run with when its outputs
+    were last written, so that an incremental run can skip texts whose
+    outputs are already up to date.
+
+    The modification time and size are compared first; the content is only
+    hashed again when they have changed, so touching a file without changing
+    it does not make it stale.
+    """
+
+    def __init__(self, directory):
+
+        """
+        Args:
+            directory (str): The text directory.
+        """
+
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.directory = directory
+        self.entries = {}
+        self.changed = False
+
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def stat(self, file_name):
+        info = os.stat(os.path.join(self.directory, file_name))
+        return info.st_mtime, info.st_size
+
+    def snapshot(self, file_name):
+
+        """
+        The modification time, size and content hash of a text, taken before
+        it is processed so that changes made meanwhile are not missed.
+        """
+
+        mtime, size = self.stat(file_name)
+        return mtime, size, file_hash(os.path.join(self.directory, file_name))
+
+    def is_current(self, file_name, key):
+
+        """
+        Whether a text's outputs were written from its current content with
+        the same parameters, and all still exist.
+
+        Args:
+            file_name (str): The text file name.
+            key (str): The parameters_key of this run.
+        """
+
+        entry = self.entries.get(file_name)
+
+        if entry is None or entry['parameters'] != key or not entry['outputs']:
+            return False
+
+        for out_name in entry['outputs']:
+            if not os.path.exists(os.path.join(self.directory, out_name)):
+                return False
+
+        mtime, size = self.stat(file_name)
+
+        if entry['mtime'] == mtime and entry['size'] == size:
+            return True
+
+        if entry['size'] != size or entry['hash'] != file_hash(os.path.join(self.directory, file_name)):
+            return False
+
+        # Touched, but not changed.
+        entry['mtime'] = mtime
+        self.changed = True
+
+        return True
+
+    def update(self, file_name, snapshot, key, outputs):
+
+        """
+        Record that a text's outputs have just been written.
+
+        Args:
+            file_name (str): The text file name.
+            snapshot (tuple): Its snapshot() from before it was processed.
+            key (str): The parameters_key of this run.
+            outputs (list): The output file names.
+        """
+
+        mtime, size, digest = snapshot
+
+        self.entries[file_name] = OrderedDict([
+            ('mtime', mtime),
+            ('size', size),
+            ('hash', digest),
+            ('parameters', key),
+            ('outputs', list(outputs)),
+        ])
+        self.changed = True
+
+    def prune(self, file_names):
+
+        """
+        Forget texts that are no longer in the directory.
+
+        Args:
+            file_names (list): The texts that are.
+        """
+
+        for file_name in set(self.entries) - set(file_names):
+            del self.entries[file_name]
+            self.changed = True
+
+    def save(self):
+
+        """
+        Write the manifest, if anything has changed since it was loaded.
+        """
+
+        if not self.changed:
+            return
+
+        temp = self.path + '.tmp'
+
+        with open(temp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+
+        os.rename(temp, self.path)
+        self.changed = False
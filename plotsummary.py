@@ -7,6 +7,8 @@
 Usage:
     plotsummary.py single <directory> <term_file> [options]
     plotsummary.py hist <directory> <term_file> [options]
+    plotsummary.py matrix <directory> <term_file> [options]
+    plotsummary.py compare <directory> <term_file> [options]
     plotsummary.py group <directory> <term_file> <term_name> <second_term_file> <second_term_name> [options]
     plotsummary.py overlap <directory> <first_term> <second_term> [options]
     plotsummary.py rawcount <directory> <term_file> [options]
@@ -15,23 +17,52 @@ Usage:
     plotsummary.py --version
 
 Options:
+    -b, --bandwidth <bandwidth>                     Specify the kernel density bandwidth in words, or in single mode a comma-separated list to sweep (default: 2000)
     -c, --caption <caption>                         Specify the output caption
+    --corpus <file>                                 Keep a document-term matrix of every text in this .npz file
+    --cache-dir <dir>                               Keep density estimates in this directory between runs
+    --cache-size <megabytes>                        Cap the memory used to cache density estimates (default: 256)
     -d, --debug                                     Enable debug output
+    -e, --export <format>                           Write the data behind each plot as csv, json or npz instead of a PNG
     -h --help                                       Show this screen.
+    -i, --index                                     Cache each text's tokens in an index file next to it
+    --incremental                                   Only process texts whose content or run parameters have changed since their outputs were written
+    -j, --jobs <jobs>                               Specify the number of files to process in parallel (default: 1)
+    -m, --metrics <metrics>                         Append per-file stage timings and counters to a JSON lines file
+    --method <method>                               Specify the search, overlap and matrix scoring method: braycurtis, cooccurrence, cosine, hellinger, intersection or jensenshannon (default: braycurtis)
     -n, --nostem <nostem>                           Specify a path containing words that should not be stemmed
+    -p, --prefetch <files>                          Read up to this many texts ahead of the one being processed, on a background thread (default: 0)
+    -s, --stems <file>                              Keep a table of the stem of every word seen in this file between runs
     --version                                       Show version.
-    -w, --words <words>                             Specify the word frequency to sample (default: 5000)
+    --window <window>                               Specify the co-occurrence window width in words (default: 50)
+    --watch <seconds>                               Keep running incrementally, checking the directory for changes every few seconds
+    -w, --words <words>                             Specify the word frequency to sample, or a comma-separated list to sweep (default: 5000)
 """
 
 import os
 from os import listdir
 from os.path import isfile, join
-from text import Text
+from text import Text, narrative_time, plot_comparison
+import cache
+import corpus
+import export
+import manifest
+import prefetch
+import stems
+import numpy as np
 import re
 from debug import Debug, Debuggable
 from docopt import docopt
 from interactive import Interactive
 import subprocess
+from collections import OrderedDict
+import sys
+import time
+import traceback
+from multiprocessing import Pool
+
+# The scoring methods search and overlap modes can compare terms by.
+METHODS = ('braycurtis', 'cooccurrence', 'cosine', 'hellinger', 'intersection', 'jensenshannon')
 
 
 class KernelDensity (Debuggable):
@@ -70,6 +101,9 @@ class KernelDensity (Debuggable):
 
         self.debug.enable_prompt(Interactive(self.args['--debug']))
 
+        if self.args['--metrics']:
+            self.debug.enable_metrics(self.args['--metrics'])
+
         if self.args['--caption']:
             self.caption = self.args['--caption']
         else:
@@ -80,6 +114,16 @@ class KernelDensity (Debuggable):
         else:
             self.nostem = None
 
+        self.index = self.args['--index']
+
+        if self.args['--watch']:
+            self.watch = float(self.args['--watch'])
+        else:
+            self.watch = None
+
+        # Watching implies an incremental run each time the directory is checked.
+        self.incremental = self.args['--incremental'] or self.watch is not None
+
         if self.args['single']:
             self.action = 'single'
         elif self.args['group']:
@@ -94,13 +138,74 @@ class KernelDensity (Debuggable):
             self.action = 'rawcount'
         elif self.args['overlap']:
             self.action = 'overlap'
+        elif self.args['matrix']:
+            self.action = 'matrix'
+        elif self.args['compare']:
+            self.action = 'compare'
         elif self.args['search']:
             self.action = 'search'
 
         if self.args['--words']:
-            self.words = int(self.args['--words'])
+            self.word_counts = [int(words) for words in self.args['--words'].split(',')]
+        else:
+            self.word_counts = [5000]
+
+        self.method = self.args['--method'] or 'braycurtis'
+
+        if self.method not in METHODS:
+            self.debug.fatal_error(self, u'--method must be one of {0}'.format(u', '.join(METHODS)))
+
+        if self.args['--bandwidth']:
+            self.bandwidths = [int(bandwidth) for bandwidth in self.args['--bandwidth'].split(',')]
+        else:
+            self.bandwidths = None
+
+        # Options passed through to every kernel density estimate; a sweep is passed separately.
+        self.density_options = {}
+
+        if self.bandwidths and len(self.bandwidths) > 1:
+            if self.action != 'single':
+                self.debug.fatal_error(self, u'Only single mode can sweep several bandwidths')
+        elif self.bandwidths:
+            self.density_options['bandwidth'] = self.bandwidths[0]
+
+        # Options passed through to the scoring method.
+        self.score_options = dict(self.density_options)
+
+        if self.method == 'cooccurrence' and self.args['--window']:
+            self.score_options['window'] = int(self.args['--window'])
+
+        self.export = self.args['--export']
+
+        if self.export and self.export not in export.FORMATS:
+            self.debug.fatal_error(self, u'--export must be one of {0}'.format(u', '.join(export.FORMATS)))
+
+        if self.args['--jobs']:
+            self.jobs = int(self.args['--jobs'])
+        else:
+            self.jobs = 1
+
+        # Worker processes each read their own texts, so prefetching only applies to a single process.
+        if self.args['--prefetch']:
+            self.prefetch = int(self.args['--prefetch'])
         else:
-            self.words = 5000
+            self.prefetch = 0
+
+        self.prefetcher = None
+
+        if self.args['--cache-size']:
+            cache_bytes = int(float(self.args['--cache-size']) * (1 << 20))
+        else:
+            cache_bytes = cache.DEFAULT_MAX_BYTES
+
+        # Worker processes inherit the configured cache and stems when they are forked.
+        cache.configure(cache_bytes, self.args['--cache-dir'])
+        stems.configure(self.args['--stems'])
+
+        self.corpus = self.args['--corpus']
+
+        if self.corpus:
+            corpus.configure(self.corpus)
 
     @staticmethod
     def read_command_line():
@@ -127,57 +232,480 @@ class KernelDensity (Debuggable):
                     else:
                         self.debug.print_debug(self, u'{0} will not be stemmed'.format(term))
 
-        file_list = listdir(self.in_dir)
+        if self.watch is None:
+            try:
+                return self.run_files()
+            finally:
+                self.save_tables()
+
+        self.debug.print_(self, u'Watching {0} for changes every {1} seconds'.format(self.in_dir, self.watch))
+
+        try:
+            while True:
+                self.run_files()
+                self.save_tables()
+                time.sleep(self.watch)
+        except KeyboardInterrupt:
+            return 0
+
+    def save_tables(self):
+        """
+        Write out what a run has accumulated across texts: the stem table and, with --corpus, the document-term matrix
+        """
+        stems.STEMS.save()
+
+        if self.corpus:
+            corpus.CORPUS.save(self.corpus)
+
+            matrix = corpus.CORPUS.matrix()
+            self.debug.print_debug(self, u'Saved a corpus of {0} texts, {1} terms and {2} non-zero counts to {3}'.format(
+                matrix.shape[0], matrix.shape[1], matrix.nnz, self.corpus))
+
+    def run_files(self):
+        """
+        Process every text in the directory, or with --incremental only those whose outputs are out of date
+        @return: the exit status
+        """
+        file_list = [file_name for file_name in listdir(self.in_dir) if file_name.endswith(".txt")]
+
+        corpus.CORPUS.prune(file_list)
+
+        # A comparison depends on every text, so it is always made afresh.
+        if self.action == 'compare':
+            return self.run_comparison(sorted(file_list))
+
+        if not self.incremental:
+            return self.plot_files(file_list)
+
+        records = manifest.Manifest(self.in_dir)
+        records.prune(file_list)
+
+        key = manifest.parameters_key(self.parameters())
+        stale = [file_name for file_name in file_list if not records.is_current(file_name, key)]
+
+        self.debug.print_debug(self, u'{0} of {1} texts are up to date'.format(len(file_list) - len(stale), len(file_list)))
+
+        snapshots = dict((file_name, records.snapshot(file_name)) for file_name in stale)
+
+        def done(file_name, result):
+            records.update(file_name, snapshots[file_name], key, self.output_files(file_name))
+
+        try:
+            return self.plot_files(stale, done)
+        finally:
+            records.save()
+
+    def plot_files(self, file_list, done=None):
+        """
+        Plot a list of files, across a process pool with --jobs
+        @param file_list: the text file names
+        @param done: called with each file name, and what plot() returned for it, once it has been plotted successfully
+        @return: the exit status
+        """
+        if self.jobs <= 1:
+            if self.prefetch > 0:
+                self.prefetcher = prefetch.Prefetcher([join(self.in_dir, file_name) for file_name in file_list],
+                                                      self.prefetch)
+
+            failures = 0
+
+            try:
+                for file_name in file_list:
+                    # An incremental run (above all a watcher) reports a bad text and moves on, leaving it stale so
+                    # that it is retried next time.
+                    try:
+                        result = self.plot(file_name)
+                    except Exception:
+                        if not self.incremental:
+                            raise
+
+                        failures += 1
+                        self.debug.print_(self, u'Failed to plot {0}:\n{1}'.format(
+                            file_name, traceback.format_exc().decode('utf8', 'replace')))
+                        continue
+
+                    if done:
+                        done(file_name, result)
+            finally:
+                if self.prefetcher is not None:
+                    self.prefetcher.close()
+                    self.prefetcher = None
+
+            return 1 if failures else 0
+
+        # Workers capture their output, which is replayed here in file order.
+        pool = Pool(self.jobs)
+        failures = 0
+
+        try:
+            for file_name, result, lines, records, added, documents, error in pool.imap(plot_in_worker, [(self, f) for f in file_list]):
+                self.debug.replay(lines)
+                self.debug.write_metrics(records)
+                stems.STEMS.merge(added)
+                corpus.CORPUS.merge(documents)
+
+                if error:
+                    failures += 1
+                    self.debug.print_(self, u'Failed to plot {0}:\n{1}'.format(file_name, error))
+                elif done:
+                    done(file_name, result)
+        finally:
+            pool.close()
+            pool.join()
+
+        return 1 if failures else 0
+
+    def parameters(self):
+        """
+        The settings that determine the outputs of a run, for deciding which outputs --incremental can keep
+        @return: an OrderedDict of JSON-serializable values
+        """
+        parameters = OrderedDict()
+        parameters['action'] = self.action
+        parameters['terms'] = self.terms
+        parameters['caption'] = self.caption
+        parameters['words'] = self.word_counts
+        parameters['method'] = self.method
+        parameters['score_options'] = self.score_options
+        parameters['bandwidths'] = self.bandwidths
+        parameters['export'] = self.export
+
+        if self.action == 'group':
+            parameters['second_terms'] = self.second_terms
+            parameters['term_names'] = [self.term_name, self.second_term_name]
+
+        if self.action == 'search':
+            parameters['count'] = self.max
+
+        # The nostem list is recorded by content, so editing it in place is noticed.
+        if self.nostem:
+            with open(self.nostem) as f:
+                parameters['nostem'] = sorted(f.read().splitlines())
+        else:
+            parameters['nostem'] = None
+
+        return parameters
+
+    def output_files(self, file_name):
+        """
+        Every file a run writes for a text
+        @param file_name: the text file name
+        @return: a list of output file names; search mode writes none unless exporting
+        """
+        if self.export:
+            return [out_name for words, out_name in self.outputs(file_name, self.export)]
+
+        if self.action == 'search':
+            return []
+
+        out_names = [out_name for words, out_name in self.outputs(file_name, 'png')]
+
+        if self.action == 'matrix':
+            out_names += [out_name.replace('.png', '.csv') for out_name in out_names]
+
+        return out_names
+
+    def targets(self):
+        """
+        The only terms a text needs to index for the current action
+        @return: a list of terms, or None if the action (or the corpus) needs the whole vocabulary
+        """
+        if self.action == 'search' or self.corpus:
+            return None
+        elif self.action == 'group':
+            return self.terms + self.second_terms
+        else:
+            return self.terms
+
+    def run_comparison(self, file_list):
+        """
+        Estimate the term densities of every text on a shared narrative time axis, then compare them in one output
+        per term
+        @param file_list: the text file names
+        @return: the exit status
+        """
+        rows = OrderedDict()
+
+        def done(file_name, densities):
+            rows[file_name] = densities
+
+        status = self.plot_files(file_list, done)
+
+        if not rows:
+            return status
 
-        for file_name in file_list:
-            if file_name.endswith(".txt"):
-                self.plot(file_name)
+        names = [file_name.replace('.txt', '') for file_name in rows]
+
+        # (texts x terms x samples), so each term's (texts x samples) block is one slice.
+        stacked = np.stack(list(rows.values()))
+
+        for i, term in enumerate(self.terms):
+            self.write_comparison(term, names, stacked[:, i, :])
+
+        return status
+
+    def write_comparison(self, term, names, densities):
+        """
+        Plot or export the densities of one term across every text
+        @param term: the unstemmed term
+        @param names: the text names
+        @param densities: a (texts x samples) matrix on the narrative time grid
+        """
+        if self.export:
+            out_name = u'comparison-{0}.{1}'.format(term, self.export)
+
+            columns = OrderedDict()
+            columns['time'] = narrative_time(densities.shape[1])
+            for name, row in zip(names, densities):
+                columns[name] = row
+
+            meta = OrderedDict()
+            meta['term'] = term
+            meta['texts'] = len(names)
+
+            self.debug.print_debug(self, u'Exporting ' + out_name)
+
+            with self.debug.span('export'):
+                export.write(join(self.in_dir, out_name), self.export, columns, meta)
+            return
+
+        out_name = u'comparison-{0}.png'.format(term)
+        self.debug.print_debug(self, u'Saving ' + out_name)
+
+        with self.debug.span('plot'):
+            graph = plot_comparison(names, densities, u'{0}: {1}'.format(self.caption, term))
+
+        with self.debug.span('savefig'):
+            graph.savefig(join(self.in_dir, out_name))
+            graph.close()
 
     def plot(self, file_name):
+        self.debug.begin_record(file=file_name, action=self.action)
+
+        try:
+            return self.plot_file(file_name)
+        finally:
+            self.debug.end_record()
+
+    def plot_file(self, file_name):
+        text = None
+
+        if self.prefetcher is not None:
+            with self.debug.span('prefetch_wait'):
+                text, depth, waited = self.prefetcher.get(join(self.in_dir, file_name))
+
+            self.debug.count('prefetch_queue_depth', depth)
+            self.debug.print_debug(self, u'Prefetch: waited {0:.3f}s for {1}, with {2} of {3} texts read ahead'.format(
+                waited, file_name, depth, self.prefetch))
+
         self.debug.print_debug(self, u'Loading ' + file_name)
 
-        textplot = Text.from_file(join(self.in_dir, file_name), self.debug, nostem=self.nostem)
+        with self.debug.span('load'):
+            textplot = Text.from_file(join(self.in_dir, file_name), self.debug, nostem=self.nostem, use_index=self.index,
+                                      targets=self.targets(), text=text)
+
+        self.debug.count('tokens', len(textplot.tokens))
+        self.debug.count('terms', len(textplot.terms))
+
+        if self.corpus:
+            corpus.CORPUS.add_text(file_name, textplot)
+
+        if self.action == 'compare':
+            # Sampling every text at the same number of points along its own length puts them all on one grid.
+            return textplot.narrative_densities([textplot.stem(term) for term in self.terms], **self.density_options)
 
+        if self.export:
+            for words, out_name in self.outputs(file_name, self.export):
+                self.export_file(textplot, out_name, words)
+            return
+
+        for words, out_name in self.outputs(file_name, 'png'):
+            self.plot_text(textplot, file_name, out_name, words)
+
+    def outputs(self, file_name, extension):
+        """
+        The window sizes to plot a file at, and the output file for each
+        @param file_name: the text file name
+        @param extension: the output file extension
+        @return: a list of (window size, output file name) pairs; a --words sweep in hist and rawcount gives one per size
+        """
+        if self.action in ('hist', 'rawcount') and len(self.word_counts) > 1:
+            return [(words, file_name.replace('.txt', u'-{0}.{1}'.format(words, extension))) for words in self.word_counts]
+
+        return [(self.word_counts[0], file_name.replace('.txt', '.' + extension))]
+
+    def plot_text(self, textplot, file_name, out_name, words):
         self.debug.print_debug(self, u'Plotting ' + file_name)
 
-        if self.action == 'single':
-            graph = textplot.plot_terms(self.terms, self.caption)
+        with self.debug.span('plot'):
+            if self.action == 'single' and self.is_sweep():
+                graph = textplot.plot_terms_sweep(self.terms, self.caption, self.bandwidths)
 
-        elif self.action == 'group':
-            graph = textplot.plot_terms_two_groups(self.terms, self.term_name, self.second_terms,self.second_term_name, self.caption)
+            elif self.action == 'single':
+                graph = textplot.plot_terms(self.terms, self.caption, **self.density_options)
 
-        elif self.action == 'hist':
-            graph = textplot.plot_terms_histogram(self.terms, self.caption, self.words)
+            elif self.action == 'group':
+                graph = textplot.plot_terms_two_groups(self.terms, self.term_name, self.second_terms,self.second_term_name, self.caption,
+                                                       **self.density_options)
 
-        elif self.action == 'rawcount':
-            graph = textplot.plot_terms_raw_count(self.terms, self.caption, self.words)
+            elif self.action == 'hist':
+                graph = textplot.plot_terms_histogram(self.terms, self.caption, words)
 
-        elif self.action == 'overlap':
-            graph = textplot.plot_kde_overlap(self.terms)
+            elif self.action == 'rawcount':
+                graph = textplot.plot_terms_raw_count(self.terms, self.caption, words)
 
-        elif self.action == 'search':
-            newterms = textplot.anchored_scores(self.terms[0])
+            elif self.action == 'overlap':
+                graph = textplot.plot_kde_overlap(self.terms, method=self.method, score_options=self.score_options,
+                                                  **self.density_options)
+
+            elif self.action == 'matrix':
+                scores = textplot.similarity_matrix(self.terms, self.method, **self.score_options)
+
+                # The matrix itself is always written alongside its heatmap.
+                out_data = out_name.replace('.png', '.csv')
+                self.debug.print_debug(self, u'Saving ' + out_data)
+                export.write(join(self.in_dir, out_data), 'csv', *self.matrix_data(textplot, scores))
+
+                graph = textplot.plot_similarity_matrix(self.terms, scores, self.caption, self.method)
 
-            count = 0
-            self.debug.print_(self, u'Top twenty correlated terms (with more than one occurrence) for {0}: '.format(self.terms[0]))
+            elif self.action == 'search':
+                anchor = textplot.stem(self.terms[0])
+                newterms = textplot.anchored_scores(anchor, self.method, min_occurrences=2, count=self.max,
+                                                    exclude=[anchor], **self.score_options)
 
-            for item in newterms:
-                if len(textplot.terms[item]) > 1 and item != textplot.stem(self.terms[0]):
-                    if count > self.max:
-                        break
+                self.debug.print_(self, u'Top twenty correlated terms (with more than one occurrence) for {0}: '.format(self.terms[0]))
 
+                for item in newterms:
                     self.debug.print_(self, item)
-                    count += 1
 
         if self.action != 'search':
-            self.debug.print_debug(self, u'Saving ' + file_name.replace('.txt', '.png'))
+            self.debug.print_debug(self, u'Saving ' + out_name)
+
+            with self.debug.span('savefig'):
+                graph.savefig(join(self.in_dir, out_name))
+                graph.close()
+
+    def export_data(self, textplot, words):
+        """
+        Compute the numbers behind the current action's plot, without rendering it
+        @param textplot: the Text to compute from
+        @param words: the window size for hist and rawcount
+        @return: an OrderedDict of equal-length columns and an OrderedDict of scalar values
+        """
+        columns = OrderedDict()
+        meta = OrderedDict()
+
+        if self.action == 'single' and self.is_sweep():
+            columns['offset'] = textplot.sample_offsets()
+            for (term, bandwidth), kde in textplot.swept_densities(self.terms, self.bandwidths).items():
+                columns[u'{0} (bandwidth {1})'.format(term, bandwidth)] = kde
+            meta['bandwidths'] = u','.join(str(bandwidth) for bandwidth in self.bandwidths)
+
+        elif self.action == 'single':
+            columns['offset'] = textplot.sample_offsets()
+            columns.update(textplot.term_densities(self.terms, **self.density_options))
+
+        elif self.action == 'group':
+            columns['offset'] = textplot.sample_offsets()
+            for name, terms in [(self.term_name, self.terms), (self.second_term_name, self.second_terms)]:
+                for term, kde in textplot.term_densities(terms, **self.density_options).items():
+                    columns[u'{0}: {1}'.format(name, term)] = kde
+
+        elif self.action in ('hist', 'rawcount'):
+            columns['offset'], counts = textplot.raw_counts(self.terms, words)
+            columns.update(counts)
+            meta['words'] = words
+
+        elif self.action == 'overlap':
+            score, kde1, kde2, overlap = textplot.kde_overlap(self.terms, self.method, self.score_options,
+                                                              **self.density_options)
+            columns['offset'] = textplot.sample_offsets()
+            columns[self.terms[0]] = kde1
+            columns[self.terms[1]] = kde2
+            columns['overlap'] = overlap
+            meta[self.method] = float(score)
+
+        elif self.action == 'matrix':
+            return self.matrix_data(textplot, textplot.similarity_matrix(self.terms, self.method, **self.score_options))
+
+        elif self.action == 'search':
+            anchor = textplot.stem(self.terms[0])
+            scores = textplot.anchored_scores(anchor, self.method, min_occurrences=2, count=self.max,
+                                              exclude=[anchor], **self.score_options)
+            columns['term'] = list(scores)
+            columns['score'] = [float(score) for score in scores.values()]
+            meta['anchor'] = anchor
+            meta['method'] = self.method
+
+        if 'bandwidth' in self.density_options and self.action not in ('hist', 'rawcount'):
+            meta['bandwidth'] = self.density_options['bandwidth']
+
+        meta['tokens'] = len(textplot.tokens)
+
+        return columns, meta
+
+    def is_sweep(self):
+        """
+        Whether densities are estimated at several bandwidths
+        """
+        return self.bandwidths is not None and len(self.bandwidths) > 1
+
+    def matrix_data(self, textplot, scores):
+        """
+        Lay out a similarity matrix for export.write
+        @param textplot: the Text it was computed from
+        @param scores: the (terms x terms) matrix
+        @return: a term column and one score column per term, and an OrderedDict of scalar values
+        """
+        columns = OrderedDict()
+        columns['term'] = self.terms
+
+        for i, term in enumerate(self.terms):
+            columns[term] = scores[:, i]
+
+        meta = OrderedDict()
+        meta['method'] = self.method
+        meta['tokens'] = len(textplot.tokens)
+
+        return columns, meta
+
+    def export_file(self, textplot, out_name, words):
+        with self.debug.span('export'):
+            columns, meta = self.export_data(textplot, words)
+
+            self.debug.print_debug(self, u'Exporting ' + out_name)
+            export.write(join(self.in_dir, out_name), self.export, columns, meta)
+
+def plot_in_worker(task):
+    """
+    Plot a single file in a worker process
+    @param task: a (KernelDensity, file name) pair
+    @return: the file name, what plot() returned, its captured debug output and metrics, the stems and corpus documents
+    it added and the traceback of any failure
+    """
+    instance, file_name = task
+    instance.debug.capture()
+
+    # Only hand back this file's document, not those the worker inherited from the parent.
+    corpus.CORPUS.clear()
+
+    # Only the parent writes the stem file; a worker hands its new stems back instead.
+    stems.STEMS.path = None
+
+    try:
+        result = instance.plot(file_name)
+        error = None
+    except BaseException:
+        result = None
+        error = traceback.format_exc().decode('utf8', 'replace')
+
+    lines, records = instance.debug.release()
+    return file_name, result, lines, records, stems.STEMS.take_added(), corpus.CORPUS.take_documents(), error
 
-            graph.savefig(join(self.in_dir, file_name.replace('.txt', '.png')))
-            graph.close()
 
 def main():
     cwf_instance = KernelDensity()
-    cwf_instance.run()
+    sys.exit(cwf_instance.run())
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
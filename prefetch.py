@@ -0,0 +1,103 @@
+import Queue
+import os
+import threading
+import time
+
+# The default number of files read ahead of the one being processed.
+DEFAULT_DEPTH = 2
+
+# Files larger than this are not read ahead, but memory-mapped as usual, so
+# that prefetching never holds more than depth x this many bytes.
+MAX_BYTES = 256 << 20
+
+
+class Prefetcher(object):
+
+    """
+    Reads a list of files, in order, on a background thread, staying up to
+    depth files ahead of the consumer, so that reading the next files (from
+    a slow or network-mounted disk) overlaps with processing the current one.
+
+    A file counts against the depth from the moment the thread starts to
+    read it until the consumer takes it, so at most depth files are held
+    besides the one being processed.
+    """
+
+    def __init__(self, paths, depth=DEFAULT_DEPTH, max_bytes=MAX_BYTES):
+
+        """
+        Args:
+            paths (list): The files, in the order they will be asked for.
+            depth (int): The most files to read ahead of the consumer.
+            max_bytes (int): Files larger than this are skipped (see get).
+        """
+
+        self.paths = list(paths)
+        self.max_bytes = max_bytes
+        self.queue = Queue.Queue()
+        self.slots = threading.Semaphore(max(depth, 1))
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target=self.read_all)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read_all(self):
+        for path in self.paths:
+            self.slots.acquire()
+
+            if self.stopped.is_set():
+                return
+
+            try:
+                if os.path.getsize(path) > self.max_bytes:
+                    text = None
+                else:
+                    with open(path, 'rb') as f:
+                        text = f.read()
+
+            # Left for the consumer to hit again, and report, when it reads the file itself.
+            except (IOError, OSError):
+                text = None
+
+            self.queue.put((path, text))
+
+    def get(self, path):
+
+        """
+        Wait for the next file to be read.
+
+        Args:
+            path (str): The file expected next.
+
+        Returns:
+            tuple: (the file's content, or None if it was too large or could
+                not be read, how many files were waiting in the queue, and
+                the seconds spent waiting for it).
+        """
+
+        depth = self.queue.qsize()
+        start = time.time()
+
+        prefetched, text = self.queue.get()
+        self.slots.release()
+
+        if prefetched != path:
+            raise ValueError(u'Expected {0} to be prefetched, not {1}'.format(path, prefetched))
+
+        return text, depth, time.time() - start
+
+    def close(self):
+
+        """
+        Stop reading ahead, and discard anything already read.
+        """
+
+        self.stopped.set()
+
+        # Wake the thread if it is waiting for a slot.
+        self.slots.release()
+        self.thread.join()
+
+        while not self.queue.empty():
+            self.queue.get()
@@ -0,0 +1,245 @@
+import imp
+import os
+
+from functools32 import lru_cache
+
+# NLTK is slow to import (most of a second), so it is only imported when a
+# word actually has to be stemmed.
+
+PORTER = None
+
+# The most words whose stems are held in memory at once.
+STEM_CACHE_SIZE = 1 << 18
+
+
+def porter():
+
+    """
+    The shared NLTK Porter stemmer, created on first use.
+    """
+
+    global PORTER
+
+    if PORTER is None:
+        from nltk.stem import PorterStemmer
+        PORTER = PorterStemmer()
+
+    return PORTER
+
+
+@lru_cache(maxsize=None)
+def stemmer_identity():
+
+    """
+    Identifies the stemmer in index keys and stem tables. The NLTK version is
+    read from its VERSION file so that a warm start never imports NLTK.
+    """
+
+    try:
+        path = imp.find_module('nltk')[1]
+        with open(os.path.join(path, 'VERSION')) as f:
+            version = f.read().strip()
+    except (ImportError, IOError):
+        import nltk
+        version = nltk.__version__
+
+    return 'nltk.PorterStemmer ' + version
+
+
+class StemTable(object):
+
+    """
+    The word -> stem table behind every stem in the process: the tokenizer's,
+    the query terms' and the debug output's all come from the same stemmer.
+
+    A word is only ever stemmed once. With a file behind the table, the
+    stems are loaded from it at start up and the new ones written back at
+    the end of a run, so a corpus pays for each distinct word once, ever.
+    The file records the stemmer it was built with, and is ignored if that
+    has changed. Worker processes inherit the loaded table when they are
+    forked, and hand back the stems they add (see take_added).
+
+    At most size words are held in memory. When a new word would go over
+    that, the stems not yet saved are written to the file (if there is one)
+    and the table starts again empty, so a long run over a large or noisy
+    corpus (every typo is a word) stays bounded; the file keeps them all.
+
+    Words on a nostem list are handled by the caller, so one table serves
+    every nostem list.
+    """
+
+    def __init__(self, path=None, size=STEM_CACHE_SIZE):
+
+        """
+        Args:
+            path (str): A file to keep the table in between runs, if any.
+            size (int): The most words to hold in memory.
+        """
+
+        self.path = path
+        self.size = size
+        self.stems = {}
+        self.added = {}
+        self.misses = 0
+
+        if path:
+            self.load()
+
+    def load(self):
+
+        """
+        Read the table from its file, up to the size of the table.
+        """
+
+        for word, stem in self.read():
+            if len(self.stems) >= self.size:
+                break
+
+            self.stems[word] = stem
+
+    def read(self):
+
+        """
+        Yield the (word, stem) pairs in the table's file: a header line naming
+        the stemmer, then one "word stem" line per word. Nothing is yielded if
+        the file is missing or was made by another stemmer.
+        """
+
+        try:
+            with open(self.path) as f:
+                if f.readline().rstrip('\n') != stemmer_identity():
+                    return
+
+                for line in f:
+                    pair = line.split()
+                    if len(pair) == 2:
+                        yield pair
+
+        except IOError:
+            pass
+
+    def stem(self, word):
+
+        """
+        Stem a word, with NLTK's Porter stemmer the first time it is seen.
+
+        Args:
+            word (str): The unstemmed word.
+        """
+
+        try:
+            return self.stems[word]
+        except KeyError:
+            self.misses += 1
+
+            if len(self.stems) >= self.size:
+                self.evict()
+
+            stem = self.stems[word] = self.added[word] = porter().stem(word)
+            return stem
+
+    def evict(self):
+
+        """
+        Save the stems added so far, and empty the table.
+        """
+
+        self.save()
+
+        # Stems that could not be saved are lost, and worked out again when next seen.
+        self.stems.clear()
+        self.added.clear()
+
+    def take_added(self):
+
+        """
+        The stems added since the last call, for a worker to hand back.
+
+        Returns:
+            dict: word -> stem.
+        """
+
+        added, self.added = self.added, {}
+        return added
+
+    def merge(self, stems):
+
+        """
+        Add stems computed elsewhere (e.g. in a worker process).
+
+        Args:
+            stems (dict): word -> stem.
+        """
+
+        for word, stem in stems.items():
+            if word not in self.stems:
+                if len(self.stems) >= self.size:
+                    self.evict()
+
+                self.stems[word] = self.added[word] = stem
+
+    def save(self):
+
+        """
+        Write the table back to its file, if it has grown. The words already
+        in the file are copied a line at a time, so those no longer held in
+        memory are kept.
+        """
+
+        if not self.path or not self.added:
+            return
+
+        temp = self.path + '.tmp'
+
+        try:
+            with open(temp, 'w') as f:
+                f.write(stemmer_identity() + '\n')
+                for word, stem in self.read():
+                    if word not in self.added:
+                        f.write(word + ' ' + stem + '\n')
+
+                for word, stem in self.added.iteritems():
+                    # Query terms can be anything; only single words are kept.
+                    if (word + stem).isalpha():
+                        f.write(word + ' ' + stem + '\n')
+
+            os.rename(temp, self.path)
+            self.added = {}
+
+        except (IOError, OSError):
+            pass
+
+    def clear(self):
+        self.stems.clear()
+        self.added.clear()
+
+    def __len__(self):
+        return len(self.stems)
+
+
+STEMS = StemTable()
+
+
+def configure(path=None):
+
+    """
+    Load the stem table shared by every text in the process.
+
+    Args:
+        path (str): The file to keep it in between runs, or None for memory only.
+    """
+
+    STEMS.clear()
+    STEMS.path = path
+
+    if path:
+        STEMS.load()
+
+
+def stem(word):
+
+    """
+    Stem a word with the shared table.
+    """
+
+    return STEMS.stem(word)
@@ -1,60 +1,387 @@
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
-import matplotlib.ticker as ticker
+import mmap
 import numpy as np
 import pkgutil
+import heapq
 import re
+import string
 from debug import Debug, Debuggable
+from cache import DENSITY_CACHE, DensityCache
+import density
+from index import TermIndex, TokenCount, index_key, index_path, read_index, write_index
+from array import array
 
-import stemming.porter2
-from nltk.stem import PorterStemmer
-from sklearn.neighbors import KernelDensity
 from collections import OrderedDict
-from functools32 import lru_cache
-from scipy.spatial import distance
+import stems
+from stems import stemmer_identity
+
+# scipy is slow to import, so it is only imported by the code that uses it.
+
+# The number of bytes read from a file at a time.
+CHUNK_SIZE = 1 << 20
+
+WORD = re.compile('[a-z]+')
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+# Folds ASCII letters to lower case in a single str.translate call.
+LOWER = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+NON_LETTER = re.compile('[^A-Za-z]')
+
+# The default width, in tokens, of the windows co-occurrence is counted in.
+COOCCURRENCE_WINDOW = 50
+
+# The number of trailing characters Porter stemming can rewrite, rather than
+# just strip (e.g. relational -> relat, dying -> die).
+STEM_SLACK = 3
+
+# The default bandwidth of densities compared across texts, as a fraction of
+# each text's length (2000 words of a 100,000-word novel).
+NARRATIVE_BANDWIDTH = 0.02
+
+
+def iter_words(chunks):
+
+    """
+    Yield the lowercased words of a text that arrives in chunks, joining up
+    words that are split across a chunk boundary.
+
+    Args:
+        chunks (iterable): The text, in order, as strings.
+
+    Yields:
+        str: The next word.
+    """
+
+    carry = ''
+
+    for chunk in chunks:
+        chunk = carry + chunk.lower()
+
+        # A word running up to the end of the chunk may continue in the next.
+        end = len(chunk.rstrip(LETTERS))
+        carry = chunk[end:]
+
+        for match in WORD.finditer(chunk, 0, end):
+            yield match.group(0)
+
+    if carry:
+        yield carry
+
+
+def words(text):
+
+    """
+    The lowercased words of a text, from whatever form it is held in.
+
+    Args:
+        text: The raw text string, an iterable of chunks of it, or a
+            MappedFile.
+    """
+
+    if isinstance(text, basestring):
+        return iter_words([text])
+
+    if isinstance(text, MappedFile):
+        return text.words()
+
+    return iter_words(text)
+
+
+class FileChunks(object):
+
+    """
+    A file that is read lazily, CHUNK_SIZE bytes at a time, each time it is
+    iterated, so the whole text never has to be held in memory.
+    """
+
+    def __init__(self, path, size=CHUNK_SIZE):
+        self.path = path
+        self.size = size
+
+    def __iter__(self):
+        with open(self.path, 'r') as f:
+            for chunk in iter(lambda: f.read(self.size), ''):
+                yield chunk
+
+
+class MappedFile(object):
+
+    """
+    A file that is memory-mapped rather than read, and tokenized a window of
+    about CHUNK_SIZE bytes at a time. Each window is cut at the end of a
+    word, found by searching the map itself, so no word is ever split and
+    no carry has to be joined onto the next window; the pages behind the
+    map are left to the OS to load and drop, so a text larger than memory
+    can still be tokenized.
+    """
+
+    def __init__(self, path, size=CHUNK_SIZE):
+        self.path = path
+        self.size = size
+
+    def __iter__(self):
+
+        """
+        Yield the raw bytes of the file, one window at a time.
+        """
+
+        with open(self.path, 'rb') as f:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # An empty file cannot be mapped.
+                return
+
+            try:
+                start = 0
+                length = len(mapped)
+
+                while start < length:
+                    end = min(start + self.size, length)
+
+                    if end < length:
+                        boundary = NON_LETTER.search(mapped, end)
+                        end = boundary.start() if boundary else length
+
+                    yield mapped[start:end]
+                    start = end
+
+            finally:
+                mapped.close()
+
+    def words(self):
+
+        """
+        Yield the lowercased words of the file. Each window is case-folded
+        in bulk, then scanned with the same pattern as iter_words, so the
+        words (and so their offsets) are identical.
+        """
+
+        for window in self:
+            for match in WORD.finditer(window.translate(LOWER)):
+                yield match.group(0)
+
+
+def distributions(densities):
+
+    """
+    Scale densities to sum to 1 along their last axis, leaving all-zero
+    densities (absent terms) as zeros.
+
+    Args:
+        densities (np.array): A density, or a (terms x samples) matrix of them.
+    """
+
+    totals = densities.sum(axis=-1)[..., np.newaxis]
+    return densities / np.where(totals > 0, totals, 1)
+
+
+def pyplot():
+
+    """
+    Import matplotlib.pyplot on first use, so that runs which only export
+    data never load it.
+    """
+
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def narrative_time(samples=1000):
+
+    """
+    The positions of the kernel density sample points as a fraction of the
+    way through a text, which are the same for texts of any length.
+    """
+
+    return np.linspace(0, 1, samples)
+
+
+def plot_comparison(names, densities, caption):
+
+    """
+    Draw the density of one term across many texts as a heatmap, one row per
+    text, on a shared narrative time axis.
+
+    Args:
+        names (list): The text names, labelling the rows.
+        densities (np.array): A (texts x samples) matrix.
+        caption (str): The graph title.
+    """
+
+    plt = pyplot()
+
+    # As in plot_similarity_matrix, too many labels would only overlap.
+    labelled = len(names) <= 100
+
+    fig, ax = plt.subplots(figsize=(10, max(3, 0.25 * len(names)) if labelled else 10))
+
+    image = ax.imshow(densities, cmap='viridis', aspect='auto', interpolation='nearest',
+                      extent=(0, 1, len(names) - 0.5, -0.5))
+    fig.colorbar(image, ax=ax).set_label('Density')
+
+    if labelled:
+        ax.set_yticks(range(len(names)))
+        ax.set_yticklabels(names)
+    else:
+        ax.set_ylabel('Text')
+
+    ax.set_xlabel('Narrative Time')
+    plt.title(caption)
+    fig.tight_layout()
+
+    return plt
+
 
 class Text (Debuggable):
 
 
     @classmethod
-    def from_file(cls, path, debug, stopwords=None, nostem=None):
+    def from_file(cls, path, debug, stopwords=None, nostem=None, use_index=False, targets=None, text=None):
 
         """
         Create a text from a file.
 
         Args:
             path (str): The file path.
+            use_index (bool): Load (or save) the tokens from an index file
+                next to the text.
+            targets (list): Only index these query terms (see __init__).
+            text (str): The content of the file, if it has already been read
+                (e.g. by a prefetch.Prefetcher); otherwise it is memory-mapped.
         """
 
-        with open(path, 'r') as f:
-            return cls(f.read(), debug, stopwords, nostem)
+        return cls(MappedFile(path) if text is None else text, debug, stopwords, nostem, index_path(path) if use_index else None, targets)
 
 
-    def __init__(self, text, debug, stopwords=None, nostem=None):
+    def __init__(self, text, debug, stopwords=None, nostem=None, index=None, targets=None):
 
         """
         Store the raw text, tokenize.
 
         Args:
-            text (str): The raw text string.
+            text (str): The raw text string, or an iterable of chunks of it
+                (such as FileChunks or MappedFile) to stream it instead.
             stopwords (str): A custom stopwords list path.
+            index (str): An index file to load the tokens from, or to save
+                them to if it is missing or stale.
+            targets (list): Query terms, as passed to stem(). If given (and
+                there is no index), only the offsets of these terms are kept.
         """
 
         self.debug = debug
         Debuggable.__init__(self, 'TextPlot')
 
         self.text = text
+        self.key = None
+        self.windows = {}
         self.load_stopwords(stopwords)
         self.load_nostem(nostem)
+
+        with self.debug.span('tokenize'):
+            if index:
+                self.tokenize_with_index(index)
+            elif targets is not None:
+                self.tokenize_targets(targets)
+            else:
+                self.tokenize()
+
+    def tokenize_with_index(self, path):
+
+        """
+        Memory-map the tokens from an index file, tokenizing and writing the
+        index first if it does not match this text and its settings.
+
+        Args:
+            path (str): The index file path.
+        """
+
+        key = self.text_key()
+        loaded = read_index(path, key)
+
+        if loaded:
+            self.debug.print_debug(self, u'Loaded tokens from {0}'.format(path))
+            self.debug.count('index_hits')
+            self.tokens, self.terms = loaded
+            return
+
         self.tokenize()
 
+        try:
+            write_index(path, key, self.tokens, self.terms)
+            self.debug.print_debug(self, u'Saved tokens to {0}'.format(path))
+        except (IOError, OSError) as e:
+            self.debug.print_debug(self, u'Could not save tokens to {0}: {1}'.format(path, e))
+
+    def tokenize_targets(self, targets):
+
+        """
+        Scan the text for a handful of query terms, keeping only their
+        offsets and the total token count. Words that cannot stem to any of
+        the targets are never stemmed.
+
+        Args:
+            targets (list): The query terms.
+        """
+
+        targets = set(self.stem(term) for term in targets)
+
+        # A Porter stem never differs from its word before its last
+        # STEM_SLACK characters, so anything else is ruled out unstemmed.
+        prefixes = tuple(set(term[:max(len(term) - STEM_SLACK, 1)] for term in targets))
+
+        postings = OrderedDict()
+        resolved = {}
+        count = 0
+
+        for offset, word in enumerate(words(self.text)):
+            count = offset + 1
+
+            try:
+                term = resolved[word]
+            except KeyError:
+                term = resolved[word] = self.target_term(word, targets, prefixes)
+
+            if term is not None:
+                postings.setdefault(term, array('i')).append(offset)
+
+        self.tokens = TokenCount(count)
+        self.terms = TermIndex.from_postings(postings)
+
+        self.debug.print_debug(self, u'Targeted scan: {0} of {1} word types matched {2} terms'.format(
+            sum(1 for term in resolved.values() if term is not None), len(resolved), len(targets)))
+
+    def target_term(self, word, targets, prefixes):
+
+        """
+        The target term a word counts towards, if any.
+
+        Args:
+            word (str): The unstemmed word.
+            targets (set): The stemmed targets.
+            prefixes (tuple): Prefixes every word that stems to a target has.
+        """
+
+        if word in self.stopwords:
+            return None
+
+        if word in self.nostem:
+            term = word
+        elif word.startswith(prefixes):
+            term = stems.stem(word)
+        else:
+            return None
+
+        return term if term in targets else None
+
     @staticmethod
     def show_stem(term):
-        return stemming.porter2.stem(term)
+        return stems.stem(term)
 
     def stem(self, term):
         if not term in self.nostem:
-            return stemming.porter2.stem(term)
+            return stems.stem(term)
         else:
             return term
 
@@ -101,31 +428,74 @@ class Text (Debuggable):
     def tokenize(self):
 
         """
-        Tokenize the text.
+        Tokenize the text into an array of term IDs (-1 for stopwords) and a
+        TermIndex of each term's offsets.
         """
 
-        self.tokens = []
-        self.terms = OrderedDict()
+        ids = {}
+        vocabulary = []
+        token_ids = array('i')
+        table = stems.STEMS
+        before = table.misses
 
         # Generate tokens.
         for token in self.tokenizer(self.text):
 
             # Ignore stopwords.
             if token['unstemmed'] in self.stopwords:
-                self.tokens.append(None)
+                token_ids.append(-1)
+                continue
 
+            # Term:
+            if token['unstemmed'] in self.nostem:
+                term = token['unstemmed']
             else:
+                term = token['stemmed']
 
-                # Token:
-                self.tokens.append(token)
+            # Intern the term on first sight.
+            term_id = ids.get(term)
+            if term_id is None:
+                term_id = ids[term] = len(vocabulary)
+                vocabulary.append(term)
 
-                # Term:
-                if token['unstemmed'] in self.nostem:
-                    offsets = self.terms.setdefault(token['unstemmed'], [])
-                else:
-                    offsets = self.terms.setdefault(token['stemmed'], [])
-                offsets.append(token['offset'])
+            token_ids.append(term_id)
 
+        self.tokens = np.array(token_ids, dtype=np.int32)
+        self.terms = TermIndex.from_token_ids(vocabulary, self.tokens)
+
+        # Every token is stemmed.
+        misses = table.misses - before
+        hits = len(token_ids) - misses
+        self.debug.count('stem_cache_hits', hits)
+        self.debug.count('stem_cache_misses', misses)
+
+        self.debug.print_debug(self, u'Stem table: {0} hits, {1} misses ({2:.1%} hit rate), {3} words held'.format(
+            hits, misses, float(hits) / max(len(token_ids), 1), len(table)))
+
+    def text_key(self):
+
+        """
+        Hash the raw text and the settings that determine its tokens, once.
+
+        Returns:
+            str: The index_key of the text.
+        """
+
+        if self.key is None:
+            self.key = index_key(self.chunks(), stemmer_identity(), self.stopwords, self.nostem)
+
+        return self.key
+
+    def chunks(self):
+
+        """
+        The raw text as an iterable of chunks.
+        """
+
+        if isinstance(self.text, basestring):
+            return [self.text]
+
+        return self.text
 
     def tokenizer(self,text):
 
@@ -133,19 +503,16 @@ class Text (Debuggable):
         Yield tokens.
 
         Args:
-            text (str): The original text.
+            text (str): The original text, an iterable of chunks of it, or a
+                MappedFile.
 
         Yields:
             dict: The next token.
         """
 
-        stem = PorterStemmer().stem
-        tokens = re.finditer('[a-z]+', text.lower())
-
-        for offset, match in enumerate(tokens):
+        stem = stems.STEMS.stem
 
-            # Get the raw token.
-            unstemmed = match.group(0)
+        for offset, unstemmed in enumerate(words(text)):
 
             yield { # Emit the token.
                 'stemmed':      stem(unstemmed),
@@ -153,37 +520,256 @@ class Text (Debuggable):
                 'offset':       offset
             }
 
-    @lru_cache(maxsize=None)
-    def kde(self, term, bandwidth=2000, samples=1000, kernel='gaussian'):
+    def kde(self, term, bandwidth=2000, samples=1000, kernel='gaussian', engine=None):
 
         """
         Estimate the kernel density of the instances of term in the text.
 
+        Densities are kept in the shared DENSITY_CACHE, keyed by the text's
+        content hash rather than the Text object, so they are reused by every
+        Text made from the same file (and across runs, with a cache directory).
+
         Args:
             term (str): A stemmed term.
             bandwidth (int): The kernel bandwidth.
             samples (int): The number of evenly-spaced sample points.
             kernel (str): The kernel function.
+            engine (str): The density engine (see density.ENGINES).
 
         Returns:
-            np.array: The density estimate.
+            np.array: The density estimate (read-only).
         """
 
         # Get the offsets of the term instances.
         try:
-            terms = np.array(self.terms[term])[:, np.newaxis]
+            terms = self.terms[term]
         except:
             return 0
 
-        # Fit the density estimator on the terms.
-        kde = KernelDensity(kernel=kernel, bandwidth=bandwidth).fit(terms)
+        length = len(self.tokens)
+        engine = engine or density.default_engine(length, bandwidth, samples, kernel)
+        key = DensityCache.key(self.text_key(), term, bandwidth, samples, kernel,
+                               density.engine_key(engine, length, bandwidth, samples))
+
+        cached = DENSITY_CACHE.get(key)
+        if cached is not None:
+            self.debug.count('density_cache_hits')
+            return cached
+
+        self.debug.count('density_cache_misses')
 
-        # Score an evely-spaced array of samples.
-        x_axis = np.linspace(0, len(self.tokens), samples)[:, np.newaxis]
-        scores = kde.score_samples(x_axis)
+        # Estimate the density at evenly-spaced samples.
+        with self.debug.span('kde'):
+            scores = density.estimate(terms, length, bandwidth, samples, kernel, engine)
+
+        self.debug.count('densities')
 
         # Scale the scores to integrate to 1.
-        return np.exp(scores) * (len(self.tokens) / samples)
+        scores = scores * (length / samples)
+
+        DENSITY_CACHE.put(key, scores)
+        return scores
+
+    def density_matrix(self, terms, bandwidth=2000, samples=1000, kernel='gaussian', engine=None):
+
+        """
+        Estimate the kernel densities of many terms in one batched pass.
+
+        Args:
+            terms (list): Stemmed terms.
+            bandwidth (int): The kernel bandwidth.
+            samples (int): The number of evenly-spaced sample points.
+            kernel (str): The kernel function.
+            engine (str): The density engine (see density.ENGINES).
+
+        Returns:
+            np.array: A (terms x samples) matrix, scaled like kde().
+        """
+
+        postings = [self.terms.get(term, []) for term in terms]
+
+        with self.debug.span('kde'):
+            scores = density.estimate_matrix(postings, len(self.tokens), bandwidth, samples, kernel, engine)
+
+        self.debug.count('densities', len(terms))
+
+        return scores * (len(self.tokens) / samples)
+
+    def narrative_densities(self, terms, bandwidth=None, samples=1000, kernel='gaussian', engine=None):
+
+        """
+        Estimate the kernel densities of many terms as distributions over
+        narrative time, which can be compared between texts of any length.
+
+        Args:
+            terms (list): Stemmed terms.
+            bandwidth (int): The kernel bandwidth, or None for the same
+                fraction of every text (see NARRATIVE_BANDWIDTH).
+            samples (int): The number of evenly-spaced sample points.
+            kernel (str): The kernel function.
+            engine (str): The density engine (see density.ENGINES).
+
+        Returns:
+            np.array: A (terms x samples) matrix, each row summing to 1 (or
+                all zeros, for an absent term).
+        """
+
+        if bandwidth is None:
+            bandwidth = max(int(round(len(self.tokens) * NARRATIVE_BANDWIDTH)), 1)
+
+        postings = [self.terms.get(term, []) for term in terms]
+
+        with self.debug.span('kde'):
+            scores = density.estimate_matrix(postings, len(self.tokens), bandwidth, samples, kernel, engine)
+
+        self.debug.count('densities', len(terms))
+
+        return distributions(scores)
+
+    def density_sweep(self, terms, bandwidths, samples=1000, kernel='gaussian'):
+
+        """
+        Estimate the kernel densities of many terms at many bandwidths,
+        sharing a binning of their offsets between the bandwidths that are
+        binned at the same resolution (see density.estimate_sweep).
+        The densities are also put in the DENSITY_CACHE, so later kde()
+        calls at any of the bandwidths are free.
+
+        Args:
+            terms (list): Stemmed terms.
+            bandwidths (list): The kernel bandwidths.
+            samples (int): The number of evenly-spaced sample points.
+            kernel (str): The kernel function.
+
+        Returns:
+            OrderedDict: bandwidth -> a (terms x samples) matrix, scaled like kde().
+        """
+
+        length = len(self.tokens)
+        postings = [self.terms.get(term, []) for term in terms]
+
+        with self.debug.span('kde'):
+            matrices = density.estimate_sweep(postings, length, bandwidths, samples, kernel)
+
+        self.debug.count('densities', len(terms) * len(bandwidths))
+
+        sweep = OrderedDict()
+
+        for bandwidth, scores in zip(bandwidths, matrices):
+            scores = scores * (length / samples)
+            engine = density.engine_key(density.default_engine(length, bandwidth, samples, kernel),
+                                        length, bandwidth, samples)
+
+            for term, row in zip(terms, scores):
+                if term in self.terms:
+                    DENSITY_CACHE.put(DensityCache.key(self.text_key(), term, bandwidth, samples, kernel, engine),
+                                      row.copy())
+
+            sweep[bandwidth] = scores
+
+        return sweep
+
+    def window_edges(self, word_count):
+
+        """
+        The edges of the consecutive windows that hist and rawcount count in:
+        len(tokens) / word_count equal windows spanning the whole text.
+
+        Args:
+            word_count (int): The approximate window size in tokens.
+        """
+
+        bins = len(self.tokens)/word_count
+
+        if bins < 1:
+            raise ValueError(u'The window size {0} is larger than the text ({1} words)'.format(word_count, len(self.tokens)))
+
+        return np.linspace(0, len(self.tokens), bins + 1)
+
+    def window_counts(self, terms, edges):
+
+        """
+        Count the occurrences of each term in arbitrary windows of the text.
+
+        Args:
+            terms (list): Unstemmed terms; those absent from the text are skipped.
+            edges (np.array): Ascending window edges, in tokens.
+
+        Returns:
+            OrderedDict: term -> the count in each window [edges[i], edges[i + 1]).
+        """
+
+        counts = OrderedDict()
+
+        for term in terms:
+            if self.stem(term) in self.terms:
+                counts[term] = self.terms.window_counts(self.stem(term), edges)
+
+        return counts
+
+    def raw_counts(self, terms, word_count):
+
+        """
+        Count the occurrences of each term in consecutive windows of the text.
+
+        Args:
+            terms (list): Unstemmed terms; those absent from the text are skipped.
+            word_count (int): The window size in tokens.
+
+        Returns:
+            tuple: (window centres, OrderedDict of term -> counts).
+        """
+
+        binEdges = self.window_edges(word_count)
+        bincenters = 0.5*(binEdges[1:]+binEdges[:-1])
+
+        return bincenters, self.window_counts(terms, binEdges)
+
+    def term_densities(self, terms, **kwargs):
+
+        """
+        The kernel density estimates behind plot_terms.
+
+        Args:
+            terms (list): Unstemmed terms.
+
+        Returns:
+            OrderedDict: term -> density (all zeros for absent terms).
+        """
+
+        samples = kwargs.get('samples', 1000)
+
+        return OrderedDict((term, np.zeros(samples) + self.kde(self.stem(term), **kwargs)) for term in terms)
+
+    def swept_densities(self, terms, bandwidths, **kwargs):
+
+        """
+        The kernel density estimates behind plot_terms_sweep.
+
+        Args:
+            terms (list): Unstemmed terms.
+            bandwidths (list): The kernel bandwidths.
+
+        Returns:
+            OrderedDict: (term, bandwidth) -> density (all zeros for absent terms).
+        """
+
+        sweep = self.density_sweep([self.stem(term) for term in terms], bandwidths, **kwargs)
+
+        densities = OrderedDict()
+        for i, term in enumerate(terms):
+            for bandwidth, scores in sweep.items():
+                densities[term, bandwidth] = scores[i]
+
+        return densities
+
+    def sample_offsets(self, samples=1000):
+
+        """
+        The word offsets of the kernel density sample points.
+        """
+
+        return np.linspace(0, len(self.tokens), samples)
 
     def plot_terms_raw_count(self, terms, caption, word_count):
 
@@ -192,26 +778,23 @@ class Text (Debuggable):
         :param term: The unstemmed term to plot.
         """
 
+        plt = pyplot()
+        import matplotlib.ticker as ticker
+
         fig, ax = plt.subplots()
 
         # Be sure to only pick integer tick locations.
         for axis in [ax.xaxis, ax.yaxis]:
             axis.set_major_locator(ticker.MaxNLocator(integer=True))
 
-        g1 = terms
-
-        for term in g1:
-            if self.stem(term) in self.terms:
-                xs = self.terms[self.stem(term)]
-
-                y,binEdges=np.histogram(xs, bins=len(self.tokens)/word_count, range=[0, len(self.tokens)])
-                bincenters = 0.5*(binEdges[1:]+binEdges[:-1])
+        bincenters, counts = self.raw_counts(terms, word_count)
 
-                average = int(float(sum(y))/float(len(y)))
+        for term, y in counts.items():
+            average = int(float(sum(y))/float(len(y)))
 
-                self.debug.print_debug(self, u'The term {0} appears on average {1} times every {2} words'.format(term, average, word_count))
+            self.debug.print_debug(self, u'The term {0} appears on average {1} times every {2} words'.format(term, average, word_count))
 
-                plt.plot(bincenters, y, label=term)
+            plt.plot(bincenters, y, label=term)
 
         plt.xlabel('Word Offset')
         plt.ylabel('Number of Occurrences')
@@ -231,18 +814,20 @@ class Text (Debuggable):
         :param term: The unstemmed term to plot.
         """
 
+        plt = pyplot()
+        import matplotlib.ticker as ticker
+
         fig, ax = plt.subplots()
 
         # Be sure to only pick integer tick locations.
         for axis in [ax.xaxis, ax.yaxis]:
             axis.set_major_locator(ticker.MaxNLocator(integer=True))
 
-        g1 = terms
+        binEdges = self.window_edges(word_count)
 
-        for term in g1:
-            if self.stem(term) in self.terms:
-                xs = self.terms[self.stem(term)]
-                plt.hist(xs, bins=len(self.tokens)/word_count, alpha=0.9, range=[0, len(self.tokens)], label=term)
+        # Draw the precomputed window counts as weights on the window edges.
+        for term, counts in self.window_counts(terms, binEdges).items():
+            plt.hist(binEdges[:-1], bins=binEdges, weights=counts, alpha=0.9, label=term)
 
         plt.xlim(0, len(self.tokens))
         plt.xlabel('Word Offset')
@@ -257,6 +842,7 @@ class Text (Debuggable):
         return plt
 
     def plot_terms(self, terms, caption, **kwargs):
+        plt = pyplot()
         g1 = terms
 
         for term in g1:
@@ -274,12 +860,42 @@ class Text (Debuggable):
 
         return plt
 
+    def plot_terms_sweep(self, terms, caption, bandwidths, **kwargs):
+
+        """
+        Plot the kernel density estimates of terms at several bandwidths,
+        one panel per bandwidth, all estimated in a single pass.
+        """
+
+        plt = pyplot()
+
+        fig, axes = plt.subplots(len(bandwidths), 1, sharex=True, squeeze=False)
+        densities = self.swept_densities(terms, bandwidths, **kwargs)
+
+        for ax, bandwidth in zip(axes[:, 0], bandwidths):
+            for term in terms:
+                ax.plot(densities[term, bandwidth], label=term)
+
+            ax.set_ylabel(u'Bandwidth {0}'.format(bandwidth))
+
+        axes[0, 0].set_title(caption)
+        axes[0, 0].legend(loc='upper right')
+        axes[-1, 0].set_xlabel('Word Offset')
+
+        fig.set_size_inches(10, 3 * len(bandwidths))
+        fig.tight_layout()
+
+        return plt
+
     def plot_terms_two_groups(self, terms, term_name, second_terms, second_term_name, caption, **kwargs):
 
         """
         War vs. peace terms.
         """
 
+        plt = pyplot()
+        import matplotlib.patches as mpatches
+
         g1 = terms
         g2 = second_terms
 
@@ -314,29 +930,155 @@ class Text (Debuggable):
         :param term2: The second term.
         """
 
+        from scipy.spatial import distance
+
         t1_kde = self.kde(term1, **kwargs)
         t2_kde = self.kde(term2, **kwargs)
 
         return 1-distance.braycurtis(t1_kde, t2_kde)
 
-    def plot_kde_overlap(self, terms, color1='#0067a2', color2='#e8a945', overlap_color='#dddddd', **kwargs):
+    @staticmethod
+    def batch_braycurtis(anchor, matrix):
+
+        """
+        Score one kernel density estimate against every row of a density
+        matrix, as score_braycurtis would one pair at a time.
+        :param anchor: The anchor density.
+        :param matrix: A (terms x samples) density matrix.
+        """
+
+        return 1-np.abs(matrix-anchor).sum(axis=1)/np.abs(matrix+anchor).sum(axis=1)
+
+    @staticmethod
+    def batch_cosine(anchor, matrix):
+
+        """
+        The cosine similarity of one kernel density estimate with every row
+        of a density matrix (0 where either is all zeros).
+        :param anchor: The anchor density.
+        :param matrix: A (terms x samples) density matrix.
+        """
+
+        anchor = np.broadcast_to(anchor, matrix.shape[1:])
+        norms = np.sqrt((matrix*matrix).sum(axis=1)) * np.sqrt(np.dot(anchor, anchor))
+
+        return np.dot(matrix, anchor) / np.where(norms > 0, norms, 1)
+
+    @staticmethod
+    def batch_jensenshannon(anchor, matrix):
+
+        """
+        1 minus the Jensen-Shannon distance (base 2, so in [0, 1]) between one
+        kernel density estimate and every row of a density matrix, each
+        treated as a distribution over the text.
+        :param anchor: The anchor density.
+        :param matrix: A (terms x samples) density matrix.
+        """
+
+        p = distributions(np.broadcast_to(anchor, matrix.shape[1:]).astype(float))
+        q = distributions(matrix)
+        m = 0.5*(p+q)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            divergence = 0.5*(np.where(p > 0, p*np.log2(p/m), 0).sum(axis=1) +
+                              np.where(q > 0, q*np.log2(q/m), 0).sum(axis=1))
+
+        scores = 1-np.sqrt(np.maximum(divergence, 0))
+
+        return np.where(q.any(axis=1) & p.any(), scores, 0)
+
+    @staticmethod
+    def batch_hellinger(anchor, matrix):
+
+        """
+        1 minus the Hellinger distance between one kernel density estimate and
+        every row of a density matrix, each treated as a distribution.
+        :param anchor: The anchor density.
+        :param matrix: A (terms x samples) density matrix.
+        """
+
+        p = distributions(np.broadcast_to(anchor, matrix.shape[1:]).astype(float))
+        q = distributions(matrix)
+
+        return 1-np.sqrt(np.maximum(1-np.dot(np.sqrt(q), np.sqrt(p)), 0))
+
+    @staticmethod
+    def batch_intersection(anchor, matrix):
+
+        """
+        The histogram intersection (the shared area) of one kernel density
+        estimate and every row of a density matrix, each scaled to sum to 1.
+        :param anchor: The anchor density.
+        :param matrix: A (terms x samples) density matrix.
+        """
+
+        p = distributions(np.broadcast_to(anchor, matrix.shape[1:]).astype(float))
+
+        return np.minimum(distributions(matrix), p).sum(axis=1)
+
+    def score(self, term1, term2, method='braycurtis', **kwargs):
+
+        """
+        Score one pair of terms with any scoring method.
+        :param term1: The first term.
+        :param term2: The second term.
+        :param method: The scoring method (see anchored_scores).
+        """
+
+        evaluator = getattr(self, 'score_'+method, None)
+        if evaluator is not None:
+            return evaluator(term1, term2, **kwargs)
+
+        anchored = getattr(self, 'anchored_'+method, None)
+        if anchored is not None:
+            return anchored(term1, [term2], **kwargs)[0][1]
+
+        return getattr(self, 'batch_'+method)(self.kde(term1, **kwargs), self.density_matrix([term2], **kwargs))[0]
+
+    def kde_overlap(self, terms, method='braycurtis', score_options=None, **kwargs):
+
+        """
+        The data behind plot_kde_overlap.
+        :param terms: The two unstemmed terms.
+        :param method: The scoring method (see anchored_scores).
+        :param score_options: Arguments for the scoring method, if not the density arguments.
+        :return: The score, both densities and their overlap.
+        """
+
+        t1 = self.stem(terms[0])
+        t2 = self.stem(terms[1])
+
+        if score_options is None:
+            score_options = kwargs
+
+        bc = self.score(t1, t2, method, **score_options)
+
+        # As in term_densities, an absent term is all zeros rather than a scalar 0.
+        samples = kwargs.get('samples', 1000)
+
+        kde1 = np.zeros(samples) + self.kde(t1, **kwargs)
+        kde2 = np.zeros(samples) + self.kde(t2, **kwargs)
+
+        return bc, kde1, kde2, np.minimum(kde1, kde2)
+
+    def plot_kde_overlap(self, terms, color1='#0067a2', color2='#e8a945', overlap_color='#dddddd',
+                         method='braycurtis', score_options=None, **kwargs):
+
+        plt = pyplot()
 
         term1 = terms[0]
         term2 = terms[1]
 
-        t1 = self.stem(term1)
-        t2 = self.stem(term2)
+        bc, kde1, kde2, overlap = self.kde_overlap(terms, method, score_options, **kwargs)
 
-        bc = self.score_braycurtis(t1, t2, **kwargs)
-
-        kde1 = self.kde(t1, **kwargs)
-        kde2 = self.kde(t2, **kwargs)
         plt.plot(kde1, color=color1, label=term1)
         plt.plot(kde2, color=color2, label=term2)
 
-        overlap = np.minimum(kde1, kde2)
         plt.fill(overlap, color=overlap_color)
-        plt.title(term1+', '+term2+' - '+str(round(bc, 4)))
+        if method == 'braycurtis':
+            plt.title(term1+', '+term2+' - '+str(round(bc, 4)))
+        else:
+            plt.title(term1+', '+term2+' - '+method+' '+str(round(bc, 4)))
 
         plt.xlabel('Word Offset')
         plt.ylabel('Number of Occurrences')
@@ -348,6 +1090,102 @@ class Text (Debuggable):
 
         return plt
 
+    @staticmethod
+    def pairwise_cosine(matrix):
+
+        """
+        The cosine similarity of every pair of rows of a density matrix, as a
+        single matrix product.
+        :param matrix: A (terms x samples) density matrix.
+        """
+
+        norms = np.sqrt((matrix*matrix).sum(axis=1))
+        norms = np.where(norms > 0, norms, 1)
+
+        return np.dot(matrix, matrix.T) / np.outer(norms, norms)
+
+    @staticmethod
+    def pairwise_hellinger(matrix):
+
+        """
+        1 minus the Hellinger distance between every pair of rows of a density
+        matrix, as a single matrix product.
+        :param matrix: A (terms x samples) density matrix.
+        """
+
+        roots = np.sqrt(distributions(matrix))
+
+        return 1-np.sqrt(np.maximum(1-np.dot(roots, roots.T), 0))
+
+    def similarity_matrix(self, terms, method='braycurtis', **kwargs):
+
+        """
+        Score every pair of terms. The densities of all the terms are
+        estimated in one batched pass, then compared with a pairwise_ method
+        if there is one, or a batch_ method one row at a time.
+        :param terms: The unstemmed terms.
+        :param method: The scoring method (see anchored_scores).
+        :return: A (terms x terms) matrix of scores.
+        """
+
+        stems = [self.stem(term) for term in terms]
+
+        anchored = getattr(self, 'anchored_'+method, None)
+        pairwise = getattr(self, 'pairwise_'+method, None)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if anchored is not None:
+                scores = np.array([[score for term, score in anchored(stem, stems, **kwargs)] for stem in stems])
+            else:
+                densities = self.density_matrix(stems, **kwargs)
+
+                if pairwise is not None:
+                    scores = pairwise(densities)
+                else:
+                    batch = getattr(self, 'batch_'+method)
+                    scores = np.array([batch(row, densities) for row in densities])
+
+        # Pairs of absent terms have no score.
+        scores[np.isnan(scores)] = 0
+
+        self.debug.count('pairs_scored', len(terms)*len(terms))
+
+        return scores
+
+    def plot_similarity_matrix(self, terms, scores, caption, method='braycurtis'):
+
+        """
+        Draw a similarity matrix as a heatmap.
+        :param terms: The unstemmed terms, labelling the rows and columns.
+        :param scores: The matrix from similarity_matrix.
+        :param caption: The graph title.
+        :param method: The scoring method, for the colour bar label.
+        """
+
+        plt = pyplot()
+
+        # Past a hundred or so terms the labels would overlap, so they are
+        # left off and the figure no longer needs to grow to fit them.
+        labelled = len(terms) <= 100
+        size = max(6, 0.2*len(terms)) if labelled else 10
+
+        fig, ax = plt.subplots(figsize=(size + 2, size))
+
+        # Pairs that never co-occur score -inf under PMI; leave them blank.
+        image = ax.imshow(np.ma.masked_invalid(scores), cmap='viridis', interpolation='nearest')
+        fig.colorbar(image, ax=ax).set_label(method)
+
+        if labelled:
+            ax.set_xticks(range(len(terms)))
+            ax.set_yticks(range(len(terms)))
+            ax.set_xticklabels(terms, rotation=90)
+            ax.set_yticklabels(terms)
+
+        plt.title(caption)
+        fig.tight_layout()
+
+        return plt
+
     def sort_dict(self, d, reverse=True):
 
         """
@@ -358,19 +1196,138 @@ class Text (Debuggable):
         sort = sorted(d.iteritems(), key=lambda x: x[1], reverse=reverse)
         return OrderedDict(sort)
 
-    def anchored_scores(self, anchor, method='braycurtis', **kwargs):
+    def batched_scores(self, anchor, terms, batch, chunk=1024, **kwargs):
+
+        """
+        Score an anchor term against many terms through a batch_ scorer.
+        :param anchor: The anchor term.
+        :param terms: The terms to score.
+        :param batch: The batched scoring function.
+        :param chunk: The number of terms whose densities are held at once.
+        """
+
+        anchor_kde = self.kde(anchor, **kwargs)
+
+        for start in range(0, len(terms), chunk):
+            block = terms[start:start+chunk]
+            scores = batch(anchor_kde, self.density_matrix(block, **kwargs))
+
+            for pair in zip(block, scores):
+                yield pair
+
+    def window_matrix(self, window=COOCCURRENCE_WINDOW):
+
+        """
+        A sparse (terms x windows) matrix recording which terms occur in each
+        consecutive window of the text, built once per window size.
+
+        Args:
+            window (int): The window width in tokens.
+
+        Returns:
+            scipy.sparse.csr_matrix: 1 where a term occurs in a window; rows
+                are indexed by term ID.
+        """
+
+        if window not in self.windows:
+            from scipy import sparse
+
+            with self.debug.span('window_matrix'):
+                counts = self.terms.counts()
+                rows = np.repeat(np.arange(len(counts)), counts)
+                columns = np.asarray(self.terms.offsets) // window
+                shape = (len(counts), len(self.tokens) // window + 1)
+
+                matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, columns)), shape=shape)
+                matrix.data[:] = 1
+
+            self.windows[window] = matrix
+
+        return self.windows[window]
+
+    def anchored_cooccurrence(self, anchor, terms, window=COOCCURRENCE_WINDOW, association='pmi', **kwargs):
+
+        """
+        Score an anchor term against many terms by how often they share a
+        window, with a single sparse matrix-vector product.
+
+        Args:
+            anchor (str): The anchor term.
+            terms (list): The terms to score.
+            window (int): The window width in tokens.
+            association (str): 'pmi' (pointwise mutual information) or 'npmi'
+                (PMI normalized to [-1, 1], which favours rare terms less).
+
+        Returns:
+            list: (term, score) pairs; terms that never share a window with
+                the anchor score -inf (PMI) or -1 (NPMI).
+        """
+
+        if association not in ('pmi', 'npmi'):
+            raise ValueError(u'Unknown association measure: {0}'.format(association))
+
+        matrix = self.window_matrix(window)
+        windows = float(matrix.shape[1])
+
+        # Terms absent from the text get an empty row of their own.
+        rows = np.array([self.terms.ids.get(term, -1) for term in terms], dtype=int)
+        present = rows >= 0
+
+        with self.debug.span('cooccurrence'):
+            joint = np.zeros(len(rows))
+            term_windows = np.zeros(len(rows))
+            anchor_windows = 0
+
+            if anchor in self.terms:
+                anchor_row = self.terms.ids[anchor]
+                joint[present] = matrix.dot(matrix.getrow(anchor_row).T).toarray().ravel()[rows[present]]
+                anchor_windows = matrix.indptr[anchor_row + 1] - matrix.indptr[anchor_row]
+
+            term_windows[present] = np.diff(matrix.indptr)[rows[present]]
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pmi = np.log(joint * windows / (anchor_windows * term_windows))
+
+                if association == 'npmi':
+                    scores = np.where(joint > 0, pmi / -np.log(joint / windows), -1.0)
+                else:
+                    scores = np.where(joint > 0, pmi, -np.inf)
+
+        return zip(terms, scores)
+
+    def anchored_scores(self, anchor, method='braycurtis', chunk=1024, min_occurrences=1, count=None,
+                        exclude=(), **kwargs):
 
         """
         Compute the intersections between an anchor term and all other terms.
         :param anchor: The anchor term.
-        :param method: The scoring function.
+        :param method: The scoring function: an anchored_ method scores all
+            terms in one call, a batch_ method a matrix of densities at a time,
+            and a score_ method one pair at a time.
+        :param chunk: The number of terms whose densities are held at once.
+        :param min_occurrences: Skip terms that occur fewer times than this.
+        :param count: Only return the top count terms.
+        :param exclude: Terms to leave out of the results.
         """
 
-        evaluator = getattr(self, 'score_'+method)
+        # Drop rare and excluded terms before any density is computed.
+        candidates = [term for term, offsets in self.terms.items()
+                      if len(offsets) >= min_occurrences and term not in exclude]
 
-        pairs = OrderedDict()
-        for term in self.terms:
-            pairs[term] = evaluator(anchor, term, **kwargs)
+        self.debug.count('terms_scored', len(candidates))
+
+        anchored = getattr(self, 'anchored_'+method, None)
+        batch = getattr(self, 'batch_'+method, None)
+
+        if anchored is not None:
+            scored = anchored(anchor, candidates, **kwargs)
+        elif batch is None:
+            evaluator = getattr(self, 'score_'+method)
+            scored = ((term, evaluator(anchor, term, **kwargs)) for term in candidates)
+        else:
+            scored = self.batched_scores(anchor, candidates, batch, chunk, **kwargs)
 
-        return self.sort_dict(pairs)
+        if count is None:
+            return self.sort_dict(OrderedDict(scored))
 
+        return OrderedDict(heapq.nlargest(count, scored, key=lambda x: x[1]))